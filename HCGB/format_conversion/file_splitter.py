@@ -9,17 +9,28 @@ Usage: split_GTF.py {OPTIONS} [.GTF file]
 
 It splits GTF into given number of files. It takes into account no genes or transcript are broken.
 It is also possible to split according to chromosome (one gtf/chromosome)
+
+FASTQ and FASTA files (plain or gzip) are split on record boundaries. Paired-end FASTQ
+files are split in lock-step, so each R1 subset matches its R2 subset. FASTA files can
+also be split into files of similar total length (balanced option).
 """
 
 import os
 import re
+import gzip
+import heapq
 import argparse
+import contextlib
 import traceback
 from termcolor import colored
 
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.files_functions as HCGB_files
+import HCGB.functions.fasta_functions as HCGB_fasta
+
+## formats split by records (see split_seq_file)
+seq_formats = ('FASTQ', 'FASTA')
 
 ############################################################
 def create_names(file2split, name_file, chr_option, num_files, in_format, debug=False):
@@ -37,29 +48,38 @@ def create_names(file2split, name_file, chr_option, num_files, in_format, debug=
     ########################
     ## Chromosome option
     ########################
+    ## keep compression for sequence files
+    ext = in_format.lower()
+    if in_format in seq_formats and file2split.endswith('.gz'):
+        ext = ext + '.gz'
+    
     if chr_option:
         
         print(file2split)
         
-        ## get list of entries
-        with open(file2split) as f:
-            
-            list2 = []
-            for row in f:
-                row = row.rstrip() ## remove empty line
-                if row:
-                    item_chr = row.split()[0]
-                    list2.append(item_chr)
+        if in_format == 'FASTA':
+            ## one file for each sequence
+            list2 = [(header.split() or [""])[0] for header, seq in HCGB_fasta.fasta_iterator(file2split)]
+        else:
+            ## get list of entries
+            with open(file2split) as f:
                 
-            ## get uniq
-            list2  = set(list2)
-            
-            ## remove # characters
-            list2 = [x for x in list2 if not x.startswith('#')]
+                list2 = []
+                for row in f:
+                    row = row.rstrip() ## remove empty line
+                    if row:
+                        item_chr = row.split()[0]
+                        list2.append(item_chr)
+                    
+                ## get uniq
+                list2  = set(list2)
+                
+                ## remove # characters
+                list2 = [x for x in list2 if not x.startswith('#')]
                   
         ## create files for list of entries
         for seq in list2:
-            file_name = name_file + "-Chr_" + str(seq) + "." + in_format.lower()
+            file_name = name_file + "-Chr_" + str(seq) + "." + ext
             dict_files_generated["Chr_" + str(seq)] = file_name
 
     else:
@@ -70,7 +90,7 @@ def create_names(file2split, name_file, chr_option, num_files, in_format, debug=
             HCGB_aes.debug_message("num_files: " + str(num_files), "yellow")
 
         for fileCount in range(num_files):
-            file_name = name_file + "-" + str(fileCount+1) + "." + in_format.lower()
+            file_name = name_file + "-" + str(fileCount+1) + "." + ext
             dict_files_generated["File_" + str(fileCount+1)] = file_name
 
     if debug:
@@ -84,7 +104,7 @@ def create_names(file2split, name_file, chr_option, num_files, in_format, debug=
     return dict_files_generated
 
 ############################################################
-def split_file_call(given_file, num_files, name, chr_option, in_format, path_given=False, debug=False):
+def split_file_call(given_file, num_files, name, chr_option, in_format, path_given=False, debug=False, given_file2=None, balanced=False):
     """
     This functions checks if it has been done previously the split of file. 
     If done, returns dict with files names generated using create_names.
@@ -94,8 +114,11 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
     :param num_files: Number of files to create with equal number of lines
     :param name: Name to include in the files names generated. By default, file basename included.
     :param chr_option: TRUE/FALSE If chr_option provided, split file into chromosome, scaffolds or reference sequences.
+    :param in_format: GTF, BED, SAM, FASTQ or FASTA
     :param path_given: Path to save results. Default use absolute path of file provided
     :param debug: TRUE/FALSE for debugging messages
+    :param given_file2: Absolute path to R2 file for paired-end FASTQ. If provided, a tuple of dictionaries (R1, R2) is returned.
+    :param balanced: TRUE/FALSE Split FASTA file into files with similar number of residues (see split_fasta_balanced)
     """
 
     ## debug messaging    
@@ -116,7 +139,17 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
         print("+ Output: Current working directory: " + path_given )
     
     ## get absolute path and name
+    name2 = ""
+    if in_format in seq_formats:
+        if given_file2 and name:
+            name2 = name + "_R2"
+            name = name + "_R1"
+        else:
+            name2 = seq_file_name(given_file2) if given_file2 else ""
+            name = name if name else seq_file_name(given_file)
+    
     name_file = HCGB_files.get_path_name(given_file, path_given, name, debug=debug)
+    name_file2 = HCGB_files.get_path_name(given_file2, path_given, name2, debug=debug) if given_file2 else None
 
     print("+ Checking if previously done...")
 
@@ -128,9 +161,10 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
 
         ## check file names generated and return names
         files_generated = create_names(given_file, name_file, chr_option, num_files, in_format, debug=debug)
+        files_generated2 = create_names(given_file2, name_file2, chr_option, num_files, in_format, debug=debug) if given_file2 else {}
 
         re_run=False
-        for f in files_generated.values():
+        for f in list(files_generated.values()) + list(files_generated2.values()):
             if not HCGB_files.is_non_zero_file(f):
                 re_run=True
                 
@@ -143,6 +177,8 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
             stamp = HCGB_time.read_time_stamp(filename_stamp)
             print("")
             print (colored("\tA previous command generated results on: %s [%s]" %(stamp, 'split file'), 'yellow'))
+            if given_file2:
+                return (files_generated, files_generated2)
             return (files_generated)
 
     print("+ Not previously done or some error ocurred during the process")
@@ -150,7 +186,8 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
     print("+ Let's do it now!")
 
     ## call to split 
-    files_generated = split_file(given_file, num_files, name_file, chr_option, in_format, path_given, debug)
+    files_generated = split_file(given_file, num_files, name_file, chr_option, in_format, path_given, debug, 
+                                 given_file2=given_file2, name2=name_file2, balanced=balanced)
     
     ## print time stamp
     HCGB_time.print_time_stamp(filename_stamp)
@@ -162,17 +199,21 @@ def split_file_call(given_file, num_files, name, chr_option, in_format, path_giv
     return (files_generated)    
     
 ############################################################
-def split_file(given_file, num_files, name, chr_option, in_format, path_given=False, debug=False):
+def split_file(given_file, num_files, name, chr_option, in_format, path_given=False, debug=False, given_file2=None, name2=None, balanced=False):
     """
-    This functions splits given file (GTF or BED) into multiple files, either a given number of files or
+    This functions splits given file (GTF, BED, SAM, FASTQ or FASTA) into multiple files, either a given number of files or
     one for each chromosome.
 
     :param given_file: Absolute path to file to split
     :param num_files: Number of files to create with equal number of lines
     :param name: Name to include in the files names generated. By default, file basename included.
     :param chr_option: TRUE/FALSE If chr_option provided, split into chromosome, scaffolds or reference sequences.
+    :param in_format: GTF, BED, SAM, FASTQ or FASTA
     :param path_given: Path to save results. Default use absolute path of file provided
     :param debug: TRUE/FALSE for debugging messages
+    :param given_file2: Absolute path to R2 file for paired-end FASTQ. If provided, a tuple of dictionaries (R1, R2) is returned.
+    :param name2: Name to include in the R2 files names generated.
+    :param balanced: TRUE/FALSE Split FASTA file into files with similar number of residues (see split_fasta_balanced)
     """
     ## init dict to store files generated
     dict_files_generated = create_names(given_file, name, chr_option, num_files, in_format, debug=debug)
@@ -199,6 +240,26 @@ def split_file(given_file, num_files, name, chr_option, in_format, path_given=Fa
     
     print("")
     
+    ## FASTQ/FASTA files are split by records
+    if in_format in seq_formats:
+        if chr_option and in_format == 'FASTQ':
+            print("ERROR: Split by reference sequence not available for FASTQ files")
+            exit()
+        
+        if balanced and in_format == 'FASTA' and not chr_option:
+            split_fasta_balanced(given_file, dict_files_generated, name + "-manifest.txt", debug=debug)
+            print("\t\t Process finished here.")
+            return (dict_files_generated)
+        
+        dict_files_generated2 = create_names(given_file2, name2, chr_option, num_files, in_format, debug=debug) if given_file2 else None
+        split_seq_file(given_file, dict_files_generated, chr_option, in_format, 
+                       given_file2=given_file2, dict_files_generated2=dict_files_generated2, debug=debug)
+        
+        print("\t\t Process finished here.")
+        if given_file2:
+            return (dict_files_generated, dict_files_generated2)
+        return (dict_files_generated)
+    
     #read a file
     fileReader = open(given_file)
             
@@ -427,6 +488,240 @@ def split_file(given_file, num_files, name, chr_option, in_format, path_given=Fa
     
     return(dict_files_generated)
 
+############################################################
+def seq_file_name(given_file):
+    """Returns the base name of a sequence file without compression and format extension."""
+    base_name = os.path.basename(given_file)
+    if base_name.endswith('.gz'):
+        base_name = base_name[:-3]
+    return os.path.splitext(base_name)[0]
+
+############################################################
+def seq_records(given_file, in_format):
+    """
+    Generator of records (bytes) for a FASTQ or FASTA file (plain or gzip).
+    
+    Records are returned as they are in the file: FASTA sequence lines are not joined.
+    """
+    if in_format == 'FASTQ':
+        for name, seq, qual in HCGB_fasta.fastq_iterator(given_file):
+            yield b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n'
+    else:
+        record = []
+        fh = gzip.open(given_file, 'rb') if given_file.endswith('.gz') else open(given_file, 'rb')
+        with fh:
+            for line in fh:
+                if line.startswith(b'>') and record:
+                    yield b''.join(record)
+                    record = []
+                if not line.endswith(b'\n'):
+                    line = line + b'\n'
+                if record or line.startswith(b'>'):
+                    record.append(line)
+        if record:
+            yield b''.join(record)
+
+############################################################
+def count_seq_records(given_file, in_format):
+    """Counts the number of records of a FASTQ or FASTA file (plain or gzip) reading binary blocks."""
+    if in_format == 'FASTQ':
+        return sum(1 for record in HCGB_fasta.fastq_iterator(given_file))
+    
+    count = 0
+    previous = b'\n'
+    for block in HCGB_fasta.block_reader(given_file):
+        count += block.count(b'\n>')
+        if previous == b'\n' and block.startswith(b'>'):
+            count += 1
+        previous = block[-1:]
+    return count
+
+############################################################
+def split_seq_file(given_file, dict_files_generated, chr_option, in_format, given_file2=None, dict_files_generated2=None, debug=False):
+    """
+    Splits FASTQ or FASTA file into the files provided without breaking any record.
+    
+    Records are distributed in consecutive blocks of equal size. If chr_option provided (FASTA), each 
+    sequence is saved in its own file. If given_file2 is provided (paired-end), both files are read 
+    in lock-step and each subset of R1 contains the same reads as the corresponding subset of R2.
+    
+    :param given_file: Absolute path to file to split (R1 for paired-end)
+    :param dict_files_generated: Dictionary of files to create (see create_names)
+    :param chr_option: TRUE/FALSE If chr_option provided, create one file per sequence (FASTA)
+    :param in_format: FASTQ or FASTA
+    :param given_file2: Absolute path to R2 file for paired-end data
+    :param dict_files_generated2: Dictionary of R2 files to create (see create_names)
+    :param debug: TRUE/FALSE for debugging messages
+    """
+    ## Check file is readable
+    if given_file2 and not (HCGB_files.is_non_zero_file(given_file2)):
+        print("ERROR: File not readable. Please check path for file:\n" + given_file2)
+        exit()
+    
+    records = seq_records(given_file, in_format)
+    records2 = seq_records(given_file2, in_format) if given_file2 else None
+    
+    if chr_option:
+        print("+ Splitting file by reference sequence...")
+        created = set()
+        for record in records:
+            header_end = record.find(b'\n')
+            fields = record[1:header_end if header_end >= 0 else len(record)].split(None, 1)
+            seq_id = fields[0].decode() if fields else ""
+            
+            ## append repeated ids to the file created
+            file_name = dict_files_generated["Chr_" + seq_id]
+            mode = 'ab' if file_name in created else 'wb'
+            created.add(file_name)
+            with (gzip.open(file_name, mode) if file_name.endswith('.gz') else open(file_name, mode)) as out_hd:
+                out_hd.write(record)
+        return (dict_files_generated)
+    
+    num_files = len(dict_files_generated)
+    print("+ Splitting file into a given number of files... " + str(num_files) + ' files requested')
+    
+    ## records per file
+    total_records = count_seq_records(given_file, in_format)
+    records_file = int(total_records/num_files) + 1
+    
+    if debug:
+        HCGB_aes.debug_message("total_records: " + str(total_records), "yellow")
+        HCGB_aes.debug_message("records_file: " + str(records_file), "yellow")
+    
+    writer = writer2 = None
+    try:
+        fileCount = 0
+        recordCount = records_file
+        buffer, buffer2 = [], []
+        for record in records:
+            if records2 is not None:
+                record2 = next(records2, None)
+                if record2 is None:
+                    raise ValueError("Different number of records in %s and %s" % (given_file, given_file2))
+                buffer2.append(record2)
+            buffer.append(record)
+            recordCount += 1
+            
+            ## new file
+            if recordCount >= records_file:
+                ## flush previous block
+                if writer:
+                    writer.write(b''.join(buffer[:-1]))
+                    writer.close()
+                    if writer2:
+                        writer2.write(b''.join(buffer2[:-1]))
+                        writer2.close()
+                    buffer, buffer2 = buffer[-1:], buffer2[-1:]
+                
+                fileCount += 1
+                recordCount = 0
+                writer = HCGB_fasta.BlockWriter(dict_files_generated["File_" + str(fileCount)])
+                if records2 is not None:
+                    writer2 = HCGB_fasta.BlockWriter(dict_files_generated2["File_" + str(fileCount)])
+            
+            elif len(buffer) >= 10000:
+                writer.write(b''.join(buffer))
+                if writer2:
+                    writer2.write(b''.join(buffer2))
+                buffer, buffer2 = [], []
+        
+        if records2 is not None and next(records2, None) is not None:
+            raise ValueError("Different number of records in %s and %s" % (given_file, given_file2))
+        
+        if writer:
+            writer.write(b''.join(buffer))
+            if writer2:
+                writer2.write(b''.join(buffer2))
+        
+        ## create empty files if less records than files requested
+        for fileCount in range(fileCount + 1, num_files + 1):
+            open(dict_files_generated["File_" + str(fileCount)], 'w').close()
+            if records2 is not None:
+                open(dict_files_generated2["File_" + str(fileCount)], 'w').close()
+    finally:
+        if writer:
+            writer.close()
+        if writer2:
+            writer2.close()
+    
+    return (dict_files_generated)
+
+############################################################
+def split_fasta_balanced(given_file, dict_files_generated, manifest, debug=False):
+    """
+    Splits FASTA file into the files provided with similar total number of residues.
+    
+    Sequences are sorted by length and each one is assigned to the file with the lowest number of 
+    residues (largest first). Within each file, sequences keep their original order.
+    
+    A tab delimited manifest file is created with the original position, sequence id, length and file
+    for each sequence, so results can be merged back in the original order (see merge_balanced).
+    
+    :param given_file: Absolute path to FASTA file to split (plain or gzip)
+    :param dict_files_generated: Dictionary of files to create (see create_names)
+    :param manifest: Absolute path for the manifest file
+    :param debug: TRUE/FALSE for debugging messages
+    """
+    print("+ Splitting file into files with similar number of residues... " + str(len(dict_files_generated)) + ' files requested')
+    
+    ## get length of each sequence
+    lengths = [(header.split()[0] if header else header, len(seq)) for header, seq in HCGB_fasta.fasta_iterator(given_file)]
+    
+    ## largest first into the least loaded file
+    file_keys = sorted(dict_files_generated.keys(), key=lambda x: int(x.split('_')[1]))
+    loads = [(0, i) for i in range(len(file_keys))]
+    assigned = [None] * len(lengths)
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i][1], reverse=True):
+        load, shard = heapq.heappop(loads)
+        assigned[index] = shard
+        heapq.heappush(loads, (load + lengths[index][1], shard))
+    
+    if debug:
+        for load, shard in sorted(loads, key=lambda x: x[1]):
+            HCGB_aes.debug_message(file_keys[shard] + ": " + str(load) + " residues", "yellow")
+    
+    ## write each record in its file
+    ## writers are closed (and flushed) even if any of them fails to open
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(HCGB_fasta.BlockWriter(dict_files_generated[key])) for key in file_keys]
+        for index, record in enumerate(seq_records(given_file, 'FASTA')):
+            writers[assigned[index]].write(record)
+    
+    with open(manifest, 'w') as manifest_hd:
+        manifest_hd.write("#index\tseq_id\tlength\tfile\n")
+        for index, (seq_id, length) in enumerate(lengths):
+            manifest_hd.write("%s\t%s\t%s\t%s\n" % (index, seq_id, length, dict_files_generated[file_keys[assigned[index]]]))
+    
+    return (dict_files_generated)
+
+############################################################
+def merge_balanced(manifest, out, results=None):
+    """
+    Merges FASTA files generated by split_fasta_balanced in the original order.
+    
+    :param manifest: Absolute path to the manifest file
+    :param out: Absolute path for the merged FASTA file
+    :param results: Dictionary of files to merge for each file of the manifest (e.g. processed subsets). 
+                    By default, the files in the manifest.
+    """
+    order = []
+    with open(manifest) as manifest_hd:
+        for line in manifest_hd:
+            if line.startswith('#'):
+                continue
+            index, seq_id, length, file_name = line.rstrip('\n').split('\t')
+            if results:
+                file_name = results[file_name]
+            order.append((seq_id, file_name))
+    
+    ## records of each file follow the original order
+    iterators = {file_name: seq_records(file_name, 'FASTA') for file_name in set(x[1] for x in order)}
+    with HCGB_fasta.BlockWriter(out) as writer:
+        for seq_id, file_name in order:
+            writer.write(next(iterators[file_name]))
+    
+    return (out)
+
 ############################################################
 def main():
     ## this code runs when call as a single script
@@ -439,7 +734,9 @@ def main():
     
     parser.add_argument('--input', '-i', help='Input file', required=True);
     
-    parser.add_argument('--input_format', '-f', dest='in_format', nargs='*', help='Input format file', choices=['BED', 'GTF'], required=True);
+    parser.add_argument('--input2', help='R2 input file for paired-end FASTQ. Split in lock-step with --input');
+    
+    parser.add_argument('--input_format', '-f', dest='in_format', nargs='*', help='Input format file', choices=['BED', 'GTF', 'SAM', 'FASTQ', 'FASTA'], required=True);
     
     parser.add_argument('--num_files','-n', type=int,
                         help='Split file into as many subfiles.', default=2);
@@ -454,13 +751,17 @@ def main():
     parser.add_argument('--split_chromosome','-c',action="store_true",
                         help='Split file for each chromosome or reference sequence available.');
 
+    parser.add_argument('--balanced','-b',action="store_true",
+                        help='Split FASTA file into files with similar number of residues.');
+
     args=parser.parse_args();
     
     ## lets split the big file provided
     files_generated = split_file_call(os.path.abspath(args.input), num_files=args.num_files, name=args.name, 
                   chr_option=args.split_chromosome, in_format=str(args.in_format[0]), 
                   path_given=os.path.abspath(args.path), 
-                  debug=False)
+                  debug=False, given_file2=os.path.abspath(args.input2) if args.input2 else None,
+                  balanced=args.balanced)
     
     print("+ Check dictionary with files generated:")    
     print(files_generated)
@@ -7,7 +7,9 @@ __all__ = [
     'system_call_functions',
     'math_functions',
     'info_functions',
-    'time_functions'
+    'time_functions',
+    'kmer_functions',
+    'trimming_functions'
     
 ]
 
@@ -19,11 +19,27 @@ With different purposes:
     - Other miscellaneous functions
 """
 ## useful imports
-from itertools import groupby
 from termcolor import colored
 import os
+import re
+import time
+import fcntl
+import heapq
+import operator
+import itertools
+import shlex
+import hashlib
+import functools
+import shutil
+import tempfile
+import subprocess
+import csv
+import concurrent.futures
+import numpy as np
+import pandas as pd
 
 from HCGB.functions import system_call_functions
+from HCGB.functions import fasta_functions
 
 #########################
 ###  BLAST callers    ###
@@ -32,7 +48,7 @@ from HCGB.functions import system_call_functions
 ###############
 def makeblastdb(DBname, fasta, makeblastDBexe, dbtype='nucl'):
     ## generate blastdb for genome
-    if (os.path.isfile(DBname + '.nhr')):
+    if (os.path.isfile(DBname + ('.phr' if dbtype == 'prot' else '.nhr'))):
         print ("+ BLAST database is already generated...")
     else:
         cmd_makeblast = "%s -in %s -input_type fasta -dbtype %s -out %s" %(makeblastDBexe, fasta, dbtype, DBname)
@@ -43,6 +59,90 @@ def makeblastdb(DBname, fasta, makeblastDBexe, dbtype='nucl'):
             print (cmd_makeblast)
             exit()
 
+###############
+def blastdb_exists(DBname, dbtype='nucl'):
+    """Returns TRUE/FALSE if all main files (or alias file for multi-volume databases) of the BLAST database exist."""
+    letter = 'p' if dbtype == 'prot' else 'n'
+    if os.path.isfile(DBname + '.' + letter + 'al'):
+        return True
+    return all(os.path.isfile(DBname + '.' + letter + ext) for ext in ('hr', 'in', 'sq'))
+
+###############
+def build_blastdb(fasta, DBname, dbtype, makeblastDBexe):
+    """
+    Generates BLAST database unless it is up-to-date with the source fasta file.
+    
+    A fingerprint (sha256) of the source fasta is stored in ``DBname.fingerprint`` once the database is 
+    successfully created, so partial builds or changes in the source fasta generate the database again. 
+    A file lock (``DBname.lock``) avoids building the same database twice by concurrent processes.
+    
+    :param fasta: Absolute path to source fasta file.
+    :param DBname: Absolute path and name for the BLAST database.
+    :param dbtype: nucl or prot.
+    :param makeblastDBexe: Absolute path to makeblastdb executable.
+    
+    :returns: OK, UP-TO-DATE or FAIL.
+    """
+    fingerprint_file = DBname + '.fingerprint'
+    ## append mode: do not truncate (modify) lock file on each call
+    with open(DBname + '.lock', 'a') as lock_hd:
+        fcntl.flock(lock_hd, fcntl.LOCK_EX)
+        try:
+            fingerprint = file_digest(fasta)
+            if blastdb_exists(DBname, dbtype) and os.path.isfile(fingerprint_file):
+                with open(fingerprint_file) as fh:
+                    if fh.read().strip() == fingerprint:
+                        return ('UP-TO-DATE')
+            
+            ## remove previous fingerprint before building
+            if os.path.isfile(fingerprint_file):
+                os.remove(fingerprint_file)
+            
+            cmd_makeblast = "%s -in %s -input_type fasta -dbtype %s -out %s" %(makeblastDBexe, fasta, dbtype, DBname)
+            code = system_call_functions.system_call(cmd_makeblast, message=False)
+            if (code == 'FAIL'):
+                print (colored('****ERROR: Some error happened during the makeblastDB command', 'red'))
+                print (cmd_makeblast)
+                return ('FAIL')
+            
+            with open(fingerprint_file, 'w') as fh:
+                fh.write(fingerprint + '\n')
+            return ('OK')
+        finally:
+            fcntl.flock(lock_hd, fcntl.LOCK_UN)
+
+###############
+def makeblastdb_batch(jobs, makeblastDBexe, threads=2):
+    """
+    Generates BLAST databases for a list of fasta files using a pool of processes.
+    
+    Databases up-to-date with their source fasta are skipped (see :func:`build_blastdb`).
+    
+    :param jobs: List of (fasta, DBname, dbtype) tuples.
+    :param makeblastDBexe: Absolute path to makeblastdb executable.
+    :param threads: Number of processes to use.
+    
+    :type jobs: list
+    :type makeblastDBexe: string
+    :type threads: int
+    
+    :returns: Dictionary with the status (OK, UP-TO-DATE or FAIL) for each database.
+    """
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        commandsSent = { executor.submit(build_blastdb, fasta, DBname, dbtype, makeblastDBexe): DBname 
+                        for fasta, DBname, dbtype in jobs }
+        for cmd2 in concurrent.futures.as_completed(commandsSent):
+            details = commandsSent[cmd2]
+            try:
+                results[details] = cmd2.result()
+            except Exception as exc:
+                print ('***ERROR:')
+                print('%r generated an exception: %s' % (details, exc))
+                results[details] = 'FAIL'
+    
+    return (results)
+
 ###############    
 def blastn(blastnexe, outFile, DBname, fasta, threads):
     # blastn 
@@ -65,10 +165,333 @@ def blastp(blastpexe, outFile, DBname, fasta, threads):
         print (cmd_blastp)
         exit()
 
+###############
+class BlastError(Exception):
+    """Raised when a BLAST command fails."""
+    pass
+
+###############
+def split_query(fasta, num_chunks, folder):
+    """
+    Splits query fasta file into consecutive chunks with similar number of residues.
+    
+    Sequences keep the original order, so merging results of each chunk in order 
+    keeps the query order.
+    
+    :param fasta: Absolute path to query fasta file (plain or gzip compressed).
+    :param num_chunks: Number of chunks to create.
+    :param folder: Absolute path to save chunks.
+    
+    :returns: List of fasta files generated.
+    """
+    total = sum(len(seq) for header, seq in fasta_functions.fasta_iterator(fasta))
+    chunk_size = total / num_chunks
+    
+    chunks = []
+    out_hd = None
+    residues = 0
+    for header, seq in fasta_functions.fasta_iterator(fasta):
+        ## new chunk when the expected proportion of residues is reached
+        if out_hd is None or (residues >= chunk_size * len(chunks) and len(chunks) < num_chunks):
+            if out_hd:
+                out_hd.close()
+            chunks.append(os.path.join(folder, 'chunk_%s.fasta' % (len(chunks) + 1)))
+            out_hd = open(chunks[-1], 'w', buffering=1048576)
+        out_hd.write(">" + header + "\n" + seq + "\n")
+        residues += len(seq)
+    
+    if out_hd:
+        out_hd.close()
+    return chunks
+
+###############
+def run_blast_chunk(cmd, retries=1):
+    """
+    Runs BLAST command provided (list of arguments), retrying if it fails.
+    
+    :raises BlastError: If the command fails in every attempt.
+    """
+    for attempt in range(retries + 1):
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode == 0:
+            return (attempt + 1)
+    
+    raise BlastError("Command failed after %s attempts (exit code %s): %s\n%s" % (
+        retries + 1, process.returncode, " ".join(cmd), process.stderr.decode(errors='replace')))
+
+###############
+def blast_parallel(blastexe, outFile, DBname, fasta, threads, num_jobs=None, chunks=None, 
+                   evalue=1e-20, outfmt='6 std qlen slen', params="", retries=1, tmp_dir=None):
+    """
+    Runs BLAST (blastn, blastp...) for a query split into chunks, using several processes at once.
+    
+    Query is split into chunks with similar number of residues (see :func:`split_query`) and 
+    ``num_jobs`` BLAST processes are run simultaneously, each one using ``threads/num_jobs`` threads. 
+    Failed chunks are retried and tabular results are merged in query order into ``outFile``.
+    
+    :param blastexe: Absolute path to BLAST executable (blastn, blastp...).
+    :param outFile: Absolute path for the output file.
+    :param DBname: BLAST database.
+    :param fasta: Absolute path to query fasta file.
+    :param threads: Total number of threads to use.
+    :param num_jobs: Number of BLAST processes to run at once. By default, threads/2 (at least 1).
+    :param chunks: Number of chunks to split query. By default, 2 x num_jobs.
+    :param evalue: E-value threshold.
+    :param outfmt: BLAST output format (tabular).
+    :param params: Additional parameters for the BLAST command.
+    :param retries: Number of times to retry a failed chunk.
+    :param tmp_dir: Folder for temporary files. By default, output folder.
+    
+    :type blastexe: string
+    :type outFile: string
+    :type DBname: string
+    :type fasta: string
+    :type threads: int
+    :type num_jobs: int
+    :type chunks: int
+    :type evalue: float
+    :type outfmt: string
+    :type params: string
+    :type retries: int
+    :type tmp_dir: string
+    
+    :raises BlastError: If any chunk fails after all retries.
+    :returns: Absolute path to output file.
+    """
+    threads = int(threads)
+    if not num_jobs:
+        num_jobs = max(1, threads // 2)
+    if not chunks:
+        chunks = 2 * num_jobs
+    threads_job = max(1, threads // num_jobs)
+    
+    folder = tempfile.mkdtemp(prefix='blast_chunks_', dir=tmp_dir if tmp_dir else os.path.dirname(os.path.abspath(outFile)))
+    try:
+        query_chunks = split_query(fasta, chunks, folder)
+        
+        commandsSent = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs) as executor:
+            for query_chunk in query_chunks:
+                cmd = [blastexe, '-db', DBname, '-query', query_chunk, '-out', query_chunk + '.out', 
+                       '-evalue', str(evalue), '-outfmt', outfmt, '-num_threads', str(threads_job)] + shlex.split(params)
+                commandsSent[executor.submit(run_blast_chunk, cmd, retries)] = query_chunk
+            
+            errors = []
+            for cmd2 in concurrent.futures.as_completed(commandsSent):
+                try:
+                    cmd2.result()
+                except BlastError as exc:
+                    errors.append(str(exc))
+        
+        if errors:
+            raise BlastError("%s of %s chunks failed:\n%s" % (len(errors), len(query_chunks), "\n".join(errors)))
+        
+        ## merge in query order
+        with open(outFile, 'wb') as out_hd:
+            for query_chunk in query_chunks:
+                with open(query_chunk + '.out', 'rb') as in_hd:
+                    shutil.copyfileobj(in_hd, out_hd, 4194304)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    
+    return (outFile)
+
+###############################
+###     BLAST cache         ###
+###############################
+
+###############
+def file_digest(file_name):
+    """Returns sha256 hexadecimal digest of the content of the file provided."""
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as fh:
+        for block in iter(lambda: fh.read(4194304), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+###############
+def db_fingerprint(DBname):
+    """
+    Returns a fingerprint (name, size and modification time of each file) for BLAST database files provided.
+    
+    Only BLAST volume and alias files (including numbered volumes, e.g. DBname.00.nhr) are considered, so 
+    lock, fingerprint or log files and other databases sharing the prefix do not modify it.
+    """
+    folder = os.path.dirname(os.path.abspath(DBname))
+    db_regex = re.compile(re.escape(os.path.basename(DBname)) + 
+                          r'(\.\d+)?\.[np](hr|in|sq|al|og|ot|tf|to|db|js|os|pi|pd)$')
+    db_files = sorted(f for f in os.listdir(folder) if db_regex.match(f))
+    info = []
+    for db_file in db_files:
+        stat = os.stat(os.path.join(folder, db_file))
+        info.append("%s:%s:%s" % (db_file, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha256("|".join(info).encode()).hexdigest()
+
+###############
+def blast_cache_key(fasta, DBname, params):
+    """Returns the cache key for a BLAST search: hash of query content, database fingerprint and parameters."""
+    key = "|".join([file_digest(fasta), db_fingerprint(DBname), params])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+###############
+def evict_cache(cache_dir, max_size):
+    """Removes least recently used files of the cache folder until its size is below max_size (bytes)."""
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.tsv'):
+            stat = os.stat(os.path.join(cache_dir, f))
+            entries.append((stat.st_mtime, stat.st_size, f))
+    
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, f in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, f))
+        except OSError:
+            continue
+        total -= size
+
+###############
+def blast_cached(blast_call, blastexe, outFile, DBname, fasta, threads, cache_dir, max_size=10737418240, **kwargs):
+    """
+    Runs a BLAST search using a result cache.
+    
+    Results are stored in ``cache_dir`` using as key a hash of the query fasta content, a fingerprint of 
+    the database files and the parameters of the search (see :func:`blast_cache_key`). If the key exists,
+    stored results are copied into ``outFile`` without running BLAST. The least recently used results are 
+    removed when the cache exceeds ``max_size``.
+    
+    :param blast_call: Function to run the search: :func:`blastn`, :func:`blastp` or :func:`blast_parallel`.
+    :param blastexe: Absolute path to BLAST executable.
+    :param outFile: Absolute path for the output file.
+    :param DBname: BLAST database.
+    :param fasta: Absolute path to query fasta file.
+    :param threads: Number of threads to use.
+    :param cache_dir: Absolute path to the cache folder.
+    :param max_size: Maximum size of the cache folder (bytes). Default 10 Gb.
+    :param kwargs: Additional parameters for ``blast_call``.
+    
+    :returns: Absolute path to output file.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    
+    params = "%s|%s|%s" % (blast_call.__name__, os.path.basename(blastexe), 
+                           ";".join("%s=%s" % (k, kwargs[k]) for k in sorted(kwargs)))
+    cache_file = os.path.join(cache_dir, blast_cache_key(fasta, DBname, params) + '.tsv')
+    
+    if os.path.isfile(cache_file):
+        print ("+ BLAST results retrieved from cache: " + cache_file)
+        shutil.copyfile(cache_file, outFile)
+        now = time.time()
+        os.utime(cache_file, (now, now)) ## mark as recently used
+        return (outFile)
+    
+    blast_call(blastexe, outFile, DBname, fasta, threads, **kwargs)
+    
+    ## store results: copy and rename to avoid partial files
+    tmp_file = cache_file + '.tmp%s' % os.getpid()
+    shutil.copyfile(outFile, tmp_file)
+    os.replace(tmp_file, cache_file)
+    evict_cache(cache_dir, max_size)
+    
+    return (outFile)
+
 ###############################
 ###  Parse BLAST results    ###
 ###############################
 
+## BLAST tabular fields: attribute name, cast for Hsp and NumPy type for the columnar loader.
+## qseqid, sseqid and gapopen keep the names used by Hsp (qid, sid and gaps), 
+## so BLAST total gaps field is named totalgaps.
+_int = (int, np.int32)
+_float = (float, np.float32)
+_str = (str, str)
+OUTFMT_FIELDS = {
+    'qseqid': ('qid',) + _str, 'qgi': ('qgi',) + _str, 'qacc': ('qacc',) + _str, 'qaccver': ('qaccver',) + _str, 
+    'qlen': ('qlen', float, np.int32), 'sseqid': ('sid',) + _str, 'sallseqid': ('sallseqid',) + _str, 
+    'sgi': ('sgi',) + _str, 'sallgi': ('sallgi',) + _str, 'sacc': ('sacc',) + _str, 'saccver': ('saccver',) + _str, 
+    'sallacc': ('sallacc',) + _str, 'slen': ('slen', float, np.int32), 'qstart': ('qstart',) + _int, 
+    'qend': ('qend',) + _int, 'sstart': ('sstart',) + _int, 'send': ('send',) + _int, 'qseq': ('qseq',) + _str, 
+    'sseq': ('sseq',) + _str, 'evalue': ('evalue', float, np.float64), 'bitscore': ('bitscore',) + _float, 
+    'score': ('score',) + _int, 'length': ('length',) + _int, 'pident': ('pident',) + _float, 
+    'nident': ('nident',) + _int, 'mismatch': ('mismatch',) + _int, 'positive': ('positive',) + _int, 
+    'gapopen': ('gaps',) + _int, 'gaps': ('totalgaps',) + _int, 'ppos': ('ppos',) + _float, 
+    'frames': ('frames',) + _str, 'qframe': ('qframe',) + _int, 'sframe': ('sframe',) + _int, 
+    'btop': ('btop',) + _str, 'staxid': ('staxid',) + _str, 'ssciname': ('ssciname',) + _str, 
+    'scomname': ('scomname',) + _str, 'sblastname': ('sblastname',) + _str, 'sskingdom': ('sskingdom',) + _str, 
+    'staxids': ('staxids',) + _str, 'sscinames': ('sscinames',) + _str, 'scomnames': ('scomnames',) + _str, 
+    'sblastnames': ('sblastnames',) + _str, 'sskingdoms': ('sskingdoms',) + _str, 'stitle': ('stitle',) + _str, 
+    'salltitles': ('salltitles',) + _str, 'sstrand': ('sstrand',) + _str, 'qcovs': ('qcovs',) + _int, 
+    'qcovhsp': ('qcovhsp',) + _int, 'qcovus': ('qcovus',) + _int}
+OUTFMT_STD = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen', 
+              'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+OUTFMT_DEFAULT = '6 std qlen slen'
+
+## formats used when printing Hsp attributes
+_OUTFMT_FORMATS = {'pident': '{0:.2f}'.format, 'evalue': '{:.1E}'.format}
+
+class OutFmt:
+    """Column specification of a BLAST tabular output (-outfmt 6 or 7). 
+    
+    Use :func:`outfmt_spec` to obtain it, so the tuples of names, casts and formats, and the 
+    :class:`Hsp` subclass with a generated constructor (:attr:`hsp_class`), are created only once 
+    for each specification string.
+    
+    :param outfmt: Specification string, e.g. '6 std qlen slen staxids'
+    """
+    
+    def __init__(self, outfmt):
+        """Initialize OutFmt instance"""
+        fields = outfmt.split()
+        if fields and fields[0].isdigit():
+            if fields[0] not in ('6', '7'):
+                raise ValueError("OutFmt():: only tabular formats (6 or 7) are supported: %s" % outfmt)
+            fields = fields[1:]
+        if not fields:
+            fields = ['std']
+        
+        specifiers = []
+        for field in fields:
+            specifiers.extend(OUTFMT_STD if field == 'std' else [field])
+        unknown = [field for field in specifiers if field not in OUTFMT_FIELDS]
+        if unknown:
+            raise ValueError("OutFmt():: unknown BLAST fields: %s" % ",".join(unknown))
+        
+        self.outfmt = outfmt
+        self.specifiers = tuple(specifiers)
+        self.names = tuple(OUTFMT_FIELDS[field][0] for field in specifiers)
+        self.casts = tuple(OUTFMT_FIELDS[field][1] for field in specifiers)
+        self.dtypes = {name: OUTFMT_FIELDS[field][2] for name, field in zip(self.names, specifiers)}
+        self.formats = tuple(_OUTFMT_FORMATS.get(name, '{0}'.format) for name in self.names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        
+        if len(self.index) != len(self.names):
+            raise ValueError("OutFmt():: duplicated BLAST fields: %s" % outfmt)
+        
+        ## constructor generated for this specification: one direct assignment per field
+        code = ["def __init__(self, fields):"]
+        for i, (name, cast) in enumerate(zip(self.names, self.casts)):
+            value = "fields[%d]" % i
+            code.append("    self.%s = %s" % (name, value if cast is str else "%s(%s)" % (cast.__name__, value)))
+        namespace = {}
+        exec("\n".join(code), namespace)
+        self.hsp_class = type('Hsp', (Hsp,), {'__init__': namespace['__init__'], '_spec': self, 
+                                              '__module__': __name__, '__qualname__': 'Hsp'})
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __reduce__(self):
+        return (outfmt_spec, (self.outfmt,))
+
+###############
+@functools.lru_cache(maxsize=None)
+def outfmt_spec(outfmt=OUTFMT_DEFAULT):
+    """Returns the :class:`OutFmt` object for the BLAST output specification string (cached)."""
+    return OutFmt(outfmt)
+
 ###########################################################################
 #The original version was retrieved from:  
 # - https://gist.github.com/aziele/e060d1c0d1ef2acb4bd67e2fc0f165a6
@@ -92,41 +515,28 @@ class Hsp:
     :param bitscore: Bit score
     :param qlen: Query length
     :param slen: Subject length
+    
+    Attributes are named after the columns of the specification provided (see :class:`OutFmt`), 
+    by default -outfmt '6 std qlen slen'. Instances created by :func:`parse` belong to the subclass 
+    generated for the specification (:attr:`OutFmt.hsp_class`).
     """
 
-    def __init__(self,entry):
-        bt_fields = entry.split('\t')
-        self.qid = bt_fields[0]
-        self.sid = bt_fields[1]
-        self.pident = float(bt_fields[2])
-        self.length = int(bt_fields[3])
-        self.mismatch = int(bt_fields[4])
-        self.gaps = int(bt_fields[5])
-        self.qstart = int(bt_fields[6])
-        self.qend = int(bt_fields[7])
-        self.sstart = int(bt_fields[8])
-        self.send = int(bt_fields[9])
-        self.evalue = float(bt_fields[10])
-        self.bitscore = float(bt_fields[11])
-        self.qlen = float(bt_fields[12])
-        self.slen = float(bt_fields[13])
+    def __init__(self, entry, spec=None):
+        ## entry might be provided already split into fields
+        if isinstance(entry, str):
+            bt_fields = entry.rstrip('\r\n').split('\t')
+        else:
+            bt_fields = entry
+        if spec is None:
+            spec = outfmt_spec()
+        self._spec = spec
+        spec.hsp_class.__init__(self, bt_fields)
+
+    def __reduce__(self):
+        return (_hsp_from_values, (self._spec.outfmt, [getattr(self, name) for name in self._spec.names]))
 
     def _format(self):
-        l = [self.qid, 
-             self.sid, 
-             '{0:.2f}'.format(self.pident),
-             '{0}'.format(self.length),
-             '{0}'.format(self.mismatch),
-             '{0}'.format(self.gaps),
-             '{0}'.format(self.qstart),
-             '{0}'.format(self.qend),
-             '{0}'.format(self.sstart),
-             '{0}'.format(self.send),
-             '{:.1E}'.format(self.evalue),
-             '{0}'.format(self.bitscore),
-             '{0}'.format(self.qlen),
-             '{0}'.format(self.slen)
-            ]
+        l = [form(getattr(self, name)) for name, form in zip(self._spec.names, self._spec.formats)]
         return l
 
     def format(self):
@@ -136,6 +546,10 @@ class Hsp:
         f = "{0}\t{1}".format(self.qid, self.sid)
         return f
 
+def _hsp_from_values(outfmt, values):
+    """Creates Hsp for the values provided (used for pickling)."""
+    return outfmt_spec(outfmt).hsp_class(values)
+
 class BlastRecord:
     """Object representing a Blast Record. 
     
@@ -206,6 +620,19 @@ class BlastRecord:
                         break
             return l
 
+    def query_coverage(self, sid=None):
+        """Return percentage of the query covered by the union of HSPs (all hits or subject provided)."""
+        intervals = sorted((min(hsp.qstart, hsp.qend), max(hsp.qstart, hsp.qend), hsp.qlen) 
+                           for hit in self.hits for hsp in hit if sid is None or hsp.sid == sid)
+        if not intervals: return 0.0
+        covered = 0
+        last_end = 0
+        for start, end, qlen in intervals:
+            if end > last_end:
+                covered += end - max(start - 1, last_end)
+                last_end = end
+        return covered / intervals[0][2] * 100
+
     def _format(self):
         l = []
         for hit in self.hits:
@@ -228,7 +655,7 @@ class BlastRecord:
 
 
 #This is a generator function!
-def parse(handle, eval_thresh=10, aln_thresh=0, length_thresh=0):
+def parse(handle, eval_thresh=10, aln_thresh=0, length_thresh=0, outfmt=OUTFMT_DEFAULT):
      """
      Script that parses BLAST output lists (in -outfmt '6 std qlen slen' format).
 
@@ -247,29 +674,519 @@ def parse(handle, eval_thresh=10, aln_thresh=0, length_thresh=0):
      :param eval_thresh: E-value cutoff for Blast results. (1-eX)
      :param aln_thresh: Alingment cutoff (%)
      :param length_thresh: Cutoff for a given length provided (bp)
+     :param outfmt: BLAST output specification string (see :class:`OutFmt`).
      
      :type handle: string
      :type eval_thresh: integer
      :type aln_thresh: integer
      :type length_thresh: integer
+     :type outfmt: string
      
      :returns: BlastRecord objetct.
      
+     Each line is split only once and thresholds are checked on the raw fields, so Hsp objects 
+     are only created for HSPs passing all filters. Specification must include qseqid and sseqid, and
+     also evalue, length and qlen if the corresponding threshold is used.
      """
-     for qid, blasts in groupby(handle, lambda l: l.split()[0]):
-         hits = []
-         prev_sid = False
-         for sid, hsps in groupby(blasts, lambda l: l.split()[1]):
+     spec = outfmt_spec(outfmt)
+     hsp_class = spec.hsp_class
+     num_fields = len(spec)
+     try:
+         qid_i = spec.index['qid']
+         sid_i = spec.index['sid']
+         evalue_i = spec.index['evalue'] if eval_thresh is not None else None
+         qlen_i = spec.index['qlen'] if (aln_thresh or length_thresh) else spec.index.get('qlen')
+         length_i = spec.index['length'] if aln_thresh else None
+     except KeyError as field:
+         raise ValueError("parse():: field %s required in outfmt: %s" % (field, outfmt))
+     
+     qid = None
+     sid = None
+     hits = []
+     hsps_temp = []
+     for line in handle:
+         fields = line.rstrip('\r\n').split('\t')
+         if len(fields) < num_fields:
+             continue ## empty or comment line
+         
+         ## new query or subject
+         if fields[qid_i] != qid:
+             if qid is not None:
+                 if hsps_temp: hits.append(hsps_temp)
+                 yield BlastRecord(qid=qid, hits=hits)
+             qid = fields[qid_i]
+             sid = fields[sid_i]
+             hits = []
              hsps_temp = []
-             for line in hsps:
-#                 line = line.functions.decode("utf-8")
-                 hsp = Hsp(line)
-                 
-                 if (hsp.qid == hsp.sid):
-                     continue ## discard reporting autohit
-                 
-                 aln = (int(hsp.length)/int(hsp.qlen))*100
-                 if aln >= aln_thresh and hsp.evalue <= eval_thresh and hsp.qlen > length_thresh:
-                     hsps_temp.append(hsp)
+         elif fields[sid_i] != sid:
              if hsps_temp: hits.append(hsps_temp)
+             sid = fields[sid_i]
+             hsps_temp = []
+         
+         if qid == sid:
+             continue ## discard reporting autohit
+         
+         ## filter on raw fields before building Hsp
+         if evalue_i is not None and float(fields[evalue_i]) > eval_thresh:
+             continue
+         if qlen_i is not None:
+             qlen = float(fields[qlen_i])
+             if not qlen > length_thresh:
+                 continue
+             if length_i is not None and (int(fields[length_i])/int(qlen))*100 < aln_thresh:
+                 continue
+         hsps_temp.append(hsp_class(fields))
+     
+     if qid is not None:
+         if hsps_temp: hits.append(hsps_temp)
          yield BlastRecord(qid=qid, hits=hits)
+
+###############
+def blast_top_hits(blast_file, out, top=1, score='bitscore', unique_subjects=True, outfmt=OUTFMT_DEFAULT):
+    """
+    Retrieves the top N hits for each query from a BLAST tabular file (by default, -outfmt '6 std qlen slen').
+    
+    Input does not need to be sorted: lines are streamed and a heap with the N best HSPs is kept 
+    for each query, so memory does not depend on the number of HSPs per query. Results are written 
+    following the order of appearance of each query, best hit first.
+    
+    :param blast_file: Absolute path to BLAST tabular file.
+    :param out: Absolute path for the reduced BLAST tabular file.
+    :param top: Number of hits to keep for each query.
+    :param score: bitscore (higher is better), evalue (lower is better) or a function that returns a score 
+                  (higher is better) for the list of fields of a line.
+    :param unique_subjects: True/False for keeping only the best HSP of each subject.
+    :param outfmt: BLAST output specification string (see :class:`OutFmt`).
+    
+    :type blast_file: string
+    :type out: string
+    :type top: int
+    :type score: string or function
+    :type unique_subjects: bool
+    :type outfmt: string
+    
+    :returns: Number of HSPs retrieved.
+    """
+    spec = outfmt_spec(outfmt)
+    if score in ('bitscore', 'evalue') and score not in spec.index:
+        raise ValueError("blast_top_hits():: field %s required in outfmt: %s" % (score, outfmt))
+    if 'qid' not in spec.index or 'sid' not in spec.index:
+        raise ValueError("blast_top_hits():: fields qseqid and sseqid required in outfmt: %s" % outfmt)
+    qid_i = spec.index['qid']
+    sid_i = spec.index['sid']
+    num_fields = len(spec)
+    
+    if score == 'bitscore':
+        bitscore_i = spec.index['bitscore']
+        score_function = lambda fields: float(fields[bitscore_i])
+    elif score == 'evalue':
+        evalue_i = spec.index['evalue']
+        score_function = lambda fields: -float(fields[evalue_i])
+    elif callable(score):
+        score_function = score
+    else:
+        raise ValueError("blast_top_hits():: score %s not supported" % score)
+    
+    heaps = {}
+    order = 0
+    with open(blast_file) as in_hd:
+        for line in in_hd:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < num_fields:
+                continue ## empty or comment line
+            
+            order += 1
+            ## worst entry at the root: lowest score, then latest line
+            entry = (score_function(fields), -order, fields[sid_i], line)
+            heap = heaps.setdefault(fields[qid_i], [])
+            
+            if unique_subjects:
+                index = next((i for i, x in enumerate(heap) if x[2] == fields[sid_i]), None)
+                if index is not None:
+                    if entry > heap[index]:
+                        heap[index] = entry
+                        heapq.heapify(heap)
+                    continue
+            
+            if len(heap) < top:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+    
+    count = 0
+    with open(out, 'w') as out_hd:
+        for qid, heap in heaps.items():
+            for entry in sorted(heap, reverse=True):
+                out_hd.write(entry[3] if entry[3].endswith('\n') else entry[3] + '\n')
+                count += 1
+    
+    return (count)
+
+###############
+def sort_blast_table(blast_file, out, max_memory=536870912, tmp_dir=None, outfmt=OUTFMT_DEFAULT):
+    """
+    Sorts BLAST tabular file (by default, -outfmt '6 std qlen slen') by query using an external merge sort.
+    
+    Lines are read in chunks that fit in ``max_memory`` (bytes, approximately), each chunk is sorted by 
+    query and subject and saved in a temporary file and all chunks are merged. Within each query, subjects 
+    are then ordered by their best bitscore (highest first), as BLAST does, so output can be grouped correctly 
+    by :func:`parse` and :class:`BlastRecord` best hits methods remain valid. HSPs of the same query and subject 
+    keep the original order. Only the lines of the query being written are kept in memory during the merge.
+    If the specification does not include bitscore, subjects are kept in alphabetical order. Comment lines 
+    (starting with #) are discarded.
+    
+    :param blast_file: Absolute path to BLAST tabular file.
+    :param out: Absolute path for the sorted file.
+    :param max_memory: Approximate memory (bytes) to use for each chunk.
+    :param tmp_dir: Folder for temporary files. By default, output folder.
+    :param outfmt: BLAST output specification string (see :class:`OutFmt`).
+    
+    :type blast_file: string
+    :type out: string
+    :type max_memory: int
+    :type tmp_dir: string
+    :type outfmt: string
+    
+    :returns: Absolute path to sorted file.
+    """
+    spec = outfmt_spec(outfmt)
+    if 'qid' not in spec.index or 'sid' not in spec.index:
+        raise ValueError("sort_blast_table():: fields qseqid and sseqid required in outfmt: %s" % outfmt)
+    qid_i = spec.index['qid']
+    sid_i = spec.index['sid']
+    bitscore_i = spec.index.get('bitscore')
+    
+    sort_key = lambda line: operator.itemgetter(qid_i, sid_i)(line.rstrip(b'\r\n').split(b'\t'))
+    folder = tempfile.mkdtemp(prefix='blast_sort_', dir=tmp_dir if tmp_dir else os.path.dirname(os.path.abspath(out)))
+    try:
+        runs = []
+        with open(blast_file, 'rb') as in_hd:
+            lines = []
+            size = 0
+            for line in in_hd:
+                if not line.strip() or line.startswith(b'#'):
+                    continue
+                if not line.endswith(b'\n'):
+                    line = line + b'\n'
+                lines.append(line)
+                size += len(line) + 100 ## approximate object overhead
+                if size >= max_memory:
+                    runs.append(_write_sorted_run(lines, sort_key, folder, len(runs)))
+                    lines = []
+                    size = 0
+            if lines:
+                runs.append(_write_sorted_run(lines, sort_key, folder, len(runs)))
+        
+        ## merge: ties are taken from earlier runs first (stable)
+        run_handles = [open(run, 'rb') for run in runs]
+        try:
+            with open(out, 'wb', buffering=4194304) as out_hd:
+                merged = heapq.merge(*run_handles, key=sort_key)
+                for qid, query_lines in itertools.groupby(merged, key=lambda line: sort_key(line)[0]):
+                    if bitscore_i is None:
+                        out_hd.writelines(query_lines)
+                    else:
+                        out_hd.writelines(_order_by_bitscore(list(query_lines), sid_i, bitscore_i))
+        finally:
+            for run_hd in run_handles:
+                run_hd.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    
+    return (out)
+
+def _order_by_bitscore(lines, sid_i, bitscore_i):
+    """Orders lines of a query (sorted by subject) by the best bitscore of each subject (stable)."""
+    groups = [list(group) for sid, group in itertools.groupby(lines, key=lambda line: line.split(b'\t')[sid_i])]
+    if len(groups) > 1:
+        groups.sort(key=lambda group: -max(float(line.split(b'\t')[bitscore_i]) for line in group))
+    return [line for group in groups for line in group]
+
+def _write_sorted_run(lines, sort_key, folder, number):
+    """Sorts lines provided and saves them in a temporary file."""
+    lines.sort(key=sort_key)
+    run = os.path.join(folder, 'run_%s.tsv' % number)
+    with open(run, 'wb', buffering=4194304) as run_hd:
+        run_hd.writelines(lines)
+    return run
+
+###############################
+###  Columnar BLAST loader  ###
+###############################
+
+## columns and types for -outfmt '6 std qlen slen' (same names as Hsp attributes)
+BLAST_COLUMNS = list(outfmt_spec().names)
+BLAST_DTYPES = dict(outfmt_spec().dtypes)
+
+###############
+def load_blast_table(blast_file, chunksize=5000000, coverage=False, outfmt=OUTFMT_DEFAULT):
+    """
+    Loads BLAST tabular output (by default, -outfmt '6 std qlen slen') into a pandas DataFrame.
+    
+    File is read in chunks and numeric columns are stored using NumPy types. Query and subject 
+    ids are stored as categorical columns, so each id is stored once and rows contain integer codes 
+    (``df.qid.cat.codes``).
+    
+    :param blast_file: Absolute path to BLAST tabular file (plain or gzip compressed).
+    :param chunksize: Number of lines to read each time.
+    :param coverage: True/False for adding query coverage columns (see :func:`add_query_coverage`).
+    :param outfmt: BLAST output specification string (see :class:`OutFmt`).
+    
+    :type blast_file: string
+    :type chunksize: int
+    :type coverage: bool
+    :type outfmt: string
+    
+    :returns: pandas DataFrame with a column for each field (same names as :class:`Hsp` attributes).
+    """
+    spec = outfmt_spec(outfmt)
+    ids = [col for col in ('qid', 'sid') if col in spec.index]
+    
+    ## only lines starting with # are comments (-outfmt 7): ids or titles might contain #
+    chunks = []
+    with fasta_functions.open_file(blast_file) as in_hd:
+        for chunk in pd.read_csv(_SkipComments(in_hd), sep='\t', header=None, names=spec.names, dtype=spec.dtypes, 
+                                 chunksize=chunksize, quoting=csv.QUOTE_NONE, na_filter=False):
+            for col in ids:
+                chunk[col] = chunk[col].astype('category')
+            chunks.append(chunk)
+    
+    if not chunks:
+        data = pd.DataFrame({col: pd.Series(dtype=('category' if col in ids else spec.dtypes[col])) 
+                             for col in spec.names})
+    else:
+        ## share categories among chunks so concatenation keeps integer codes
+        for col in ids:
+            categories = pd.api.types.union_categoricals([chunk[col] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+        data = pd.concat(chunks, ignore_index=True)
+    
+    if coverage:
+        add_query_coverage(data)
+    
+    return data
+
+class _SkipComments:
+    """File-like object returning the lines of the handle provided, except those starting with #."""
+    
+    def __init__(self, handle):
+        self.handle = handle
+    
+    def read(self, size=-1):
+        hint = size if size and size > 0 else -1
+        while True:
+            lines = self.handle.readlines(hint)
+            if not lines:
+                return ''
+            text = ''.join(line for line in lines if not line.startswith('#'))
+            if text:
+                return text
+    
+    def __iter__(self):
+        return (line for line in self.handle if not line.startswith('#'))
+
+###############
+def interval_union_length(groups, starts, ends):
+    """
+    Returns the length covered by the union of intervals of each group.
+    
+    Intervals are sorted by group and start and swept once: the running maximum end is computed 
+    with a single cumulative maximum, shifting the coordinates of each group so that groups do not 
+    overlap. Coordinates are 1-based and inclusive, as in BLAST output.
+    
+    :param groups: Integer array with the group code (0 to N-1) of each interval.
+    :param starts: Integer array of start coordinates.
+    :param ends: Integer array of end coordinates.
+    
+    :returns: NumPy int64 array with the covered length for each group code.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    
+    ## half-open intervals [start - 1, end) regardless of strand
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    starts, ends = np.minimum(starts, ends) - 1, np.maximum(starts, ends)
+    if not len(groups):
+        return np.zeros(0, dtype=np.int64)
+    
+    order = np.lexsort((starts, groups))
+    groups = groups[order]
+    shift = groups * (int(ends.max()) + 1)
+    starts = starts[order] + shift
+    ends = ends[order] + shift
+    
+    ## maximum end of the previous intervals within each group (group shift for the first one)
+    previous = np.empty(len(ends), dtype=np.int64)
+    previous[0] = shift[0]
+    previous[1:] = np.maximum.accumulate(ends)[:-1]
+    previous = np.maximum(previous, shift)
+    
+    covered = np.maximum(ends - np.maximum(starts, previous), 0)
+    return np.bincount(groups, weights=covered, minlength=n_groups).astype(np.int64)
+
+###############
+def add_query_coverage(data):
+    """
+    Adds query coverage columns to a BLAST DataFrame (see :func:`load_blast_table`).
+    
+    Coverage is the percentage of the query length covered by the union of HSPs on the query:
+        - ``qcov_union``: all HSPs of the query
+        
+        - ``qcov_hit``: HSPs of the query and the subject of the row
+    
+    :param data: pandas DataFrame with BLAST results.
+    
+    :returns: The same DataFrame provided, with the new columns.
+    """
+    qcodes = data['qid'].cat.codes.to_numpy().astype(np.int64)
+    qlen = data['qlen'].to_numpy()
+    
+    covered = interval_union_length(qcodes, data['qstart'].to_numpy(), data['qend'].to_numpy())
+    data['qcov_union'] = (covered[qcodes] / qlen * 100).astype(np.float32) if len(data) else np.float32()
+    
+    ## integer code for each (query, subject) pair
+    pairs = qcodes * len(data['sid'].cat.categories) + data['sid'].cat.codes.to_numpy()
+    pair_codes = np.unique(pairs, return_inverse=True)[1]
+    covered = interval_union_length(pair_codes, data['qstart'].to_numpy(), data['qend'].to_numpy())
+    data['qcov_hit'] = (covered[pair_codes] / qlen * 100).astype(np.float32) if len(data) else np.float32()
+    
+    return data
+
+class BlastTableRecord:
+    """Object representing all HSPs of a query in a :class:`BlastTable`, similar to :class:`BlastRecord`. 
+    
+    :param qid: Query sequence id
+    :param hsps: DataFrame view with the HSPs of the query
+    """
+    
+    def __init__(self, qid, hsps):
+        """Initialize Blast Table Record instance"""
+        self.qid = qid
+        self.hsps = hsps
+    
+    def evalue_cutoff(self, evalue):
+        """Filter HSPs by given e-value."""
+        self.hsps = self.hsps[self.hsps['evalue'] <= evalue]
+    
+    def best_hsps(self):
+        """Return HSPs that obtain the maximum score."""
+        if self.hsps.empty:
+            return self.hsps
+        return self.hsps[self.hsps['bitscore'] >= self.hsps['bitscore'].max()]
+    
+    def best_hsps_except_query(self):
+        """Return HSPs that obtain the maximum score, discarding hits to the query itself."""
+        hsps = self.hsps[self.hsps['sid'].astype(str) != self.qid]
+        if hsps.empty:
+            return hsps
+        return hsps[hsps['bitscore'] >= hsps['bitscore'].max()]
+    
+    def query_coverage(self, sid=None):
+        """Return percentage of the query covered by the union of HSPs (all hits or subject provided)."""
+        hsps = self.hsps if sid is None else self.hsps[self.hsps['sid'] == sid]
+        if hsps.empty:
+            return 0.0
+        covered = interval_union_length(np.zeros(len(hsps), dtype=np.int64), hsps['qstart'], hsps['qend'])
+        return float(covered[0]) / float(hsps['qlen'].iloc[0]) * 100
+    
+    def __len__(self):
+        return len(self.hsps)
+
+class BlastTable:
+    """Columnar representation of BLAST tabular results. 
+    
+    Rows are grouped by query (keeping the original order within each query) and an offset table 
+    provides per-query views without creating an object for each HSP.
+    
+    :param data: pandas DataFrame (see :func:`load_blast_table`)
+    """
+    
+    def __init__(self, data):
+        """Initialize Blast Table instance"""
+        codes = data['qid'].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        self.data = data.iloc[order].reset_index(drop=True)
+        codes = codes[order]
+        
+        ## offsets of each query
+        self._codes = np.unique(codes)
+        self._starts = np.searchsorted(codes, self._codes, side='left')
+        self._ends = np.searchsorted(codes, self._codes, side='right')
+        self._index = {self.data['qid'].cat.categories[code]: i for i, code in enumerate(self._codes.tolist())}
+    
+    @classmethod
+    def from_file(cls, blast_file, chunksize=5000000, outfmt=OUTFMT_DEFAULT):
+        """Creates Blast Table for the BLAST tabular file provided (see :func:`load_blast_table`)."""
+        return cls(load_blast_table(blast_file, chunksize, outfmt=outfmt))
+    
+    def __len__(self):
+        return len(self._codes)
+    
+    def __contains__(self, qid):
+        return qid in self._index
+    
+    def __getitem__(self, qid):
+        i = self._index[qid]
+        return BlastTableRecord(qid, self.data.iloc[self._starts[i]:self._ends[i]])
+    
+    def __iter__(self):
+        """Iterate over BlastTableRecord for each query."""
+        categories = self.data['qid'].cat.categories
+        for code, start, end in zip(self._codes.tolist(), self._starts.tolist(), self._ends.tolist()):
+            yield BlastTableRecord(categories[code], self.data.iloc[start:end])
+
+###############
+def best_hits_table(data):
+    """
+    Returns the best HSP for each query of a BLAST table (see :func:`load_blast_table`).
+    
+    The HSP with the highest bitscore is retrieved (lowest e-value in case of ties), using a 
+    vectorized sort on the integer codes of the queries.
+    """
+    codes = data['qid'].cat.codes.to_numpy()
+    order = np.lexsort((data['evalue'].to_numpy(), -data['bitscore'].to_numpy(), codes))
+    codes = codes[order]
+    first = np.ones(len(codes), dtype=np.bool_)
+    first[1:] = codes[1:] != codes[:-1]
+    return data.iloc[order[first]].reset_index(drop=True)
+
+###############
+def reciprocal_best_hits(blast_AB, blast_BA, out=None):
+    """
+    Obtains reciprocal best hits (RBH) between two BLAST searches: A vs B and B vs A.
+    
+    Each table is reduced to the best hit of each query (see :func:`best_hits_table`) and both 
+    are joined using integer codes shared for the ids of each genome.
+    
+    :param blast_AB: Absolute path to BLAST tabular file (A vs B) or DataFrame (see :func:`load_blast_table`).
+    :param blast_BA: Absolute path to BLAST tabular file (B vs A) or DataFrame (see :func:`load_blast_table`).
+    :param out: Absolute path for a tab delimited file with the pairs. 
+    
+    :returns: pandas DataFrame with columns: qid, sid, pident, evalue and bitscore for A vs B and B vs A.
+    """
+    best_AB = best_hits_table(blast_AB if isinstance(blast_AB, pd.DataFrame) else load_blast_table(blast_AB))
+    best_BA = best_hits_table(blast_BA if isinstance(blast_BA, pd.DataFrame) else load_blast_table(blast_BA))
+    
+    ## shared integer codes for ids of A and of B
+    ids_A = pd.api.types.union_categoricals([best_AB['qid'], best_BA['sid']]).categories
+    ids_B = pd.api.types.union_categoricals([best_AB['sid'], best_BA['qid']]).categories
+    
+    AB = pd.DataFrame({'a': best_AB['qid'].cat.set_categories(ids_A).cat.codes,
+                       'b': best_AB['sid'].cat.set_categories(ids_B).cat.codes,
+                       'pident_AB': best_AB['pident'], 'evalue_AB': best_AB['evalue'], 'bitscore_AB': best_AB['bitscore']})
+    BA = pd.DataFrame({'a': best_BA['sid'].cat.set_categories(ids_A).cat.codes,
+                       'b': best_BA['qid'].cat.set_categories(ids_B).cat.codes,
+                       'pident_BA': best_BA['pident'], 'evalue_BA': best_BA['evalue'], 'bitscore_BA': best_BA['bitscore']})
+    
+    ## hash join on both codes
+    rbh = AB.merge(BA, on=['a', 'b'], how='inner')
+    rbh.insert(0, 'qid', ids_A[rbh['a'].to_numpy()])
+    rbh.insert(1, 'sid', ids_B[rbh['b'].to_numpy()])
+    rbh = rbh.drop(columns=['a', 'b'])
+    
+    if out:
+        rbh.to_csv(out, sep='\t', index=False)
+    
+    return (rbh)
@@ -20,11 +20,20 @@ With different purposes:
 """
 ## useful imports
 import re
+import os
+import gzip
+import queue
+import threading
+import json
+import hashlib
+import random
+import itertools
+import contextlib
+import concurrent.futures
+import numpy as np
 from Bio import SeqIO
 from termcolor import colored
 from collections import defaultdict
-##
-from HCGB.functions import system_call_functions
 
 #################################
 ###         FASTA files        ##
@@ -54,10 +63,153 @@ def ReverseComplement(seq):
     return "".join([seq_dict[base] for base in reversed(seq)])
 
 ###############
-def concat_fasta(dirFasta, Fasta):
-    print ("+ Concatenating all information into one file...")    
-    cmd = 'cat ' + dirFasta + '/*fna > ' + Fasta
-    return(system_call_functions.system_call(cmd))
+def concat_fasta(dirFasta, Fasta, ext='fna', prefix=False, dedup_headers=False, threads=4, compresslevel=6):
+    """
+    Concatenates all fasta files within the folder provided into one file.
+    
+    Files ending with the extension provided (plain or .gz) are streamed in alphabetical order, 
+    without any system call, so there is no limit in the number of files. A pool of threads opens 
+    the next files and reads (and decompresses) their first blocks ahead while the current file is 
+    written. Files are copied in fixed-size blocks, so memory does not depend on file size. Headers 
+    are rewritten line by line only if prefix or dedup_headers is set.
+    
+    :param dirFasta: Absolute path to folder containing fasta files.
+    :param Fasta: Absolute path for the output fasta file. If it ends with .gz, output is compressed.
+    :param ext: Extension of files to concatenate.
+    :param prefix: True/False for adding the file name as a prefix to each header (name_header).
+    :param dedup_headers: True/False for renaming duplicated sequence ids adding a suffix (id_2, id_3...).
+    :param threads: Number of files read ahead (up to 8 Mb each) by the pool of threads.
+    :param compresslevel: Compression level for gzip output.
+    
+    :type dirFasta: string
+    :type Fasta: string
+    :type ext: string
+    :type prefix: bool
+    :type dedup_headers: bool
+    :type threads: int
+    :type compresslevel: int
+    
+    :returns: OK/FAIL
+    """
+    print ("+ Concatenating all information into one file...")
+    
+    list_files = sorted([os.path.join(dirFasta, f) for f in os.listdir(dirFasta) 
+                         if f.endswith(ext) or f.endswith(ext + '.gz')])
+    threads = max(1, threads)
+    
+    seen_ids = defaultdict(int)
+    try:
+        if Fasta.endswith('.gz'):
+            out_hd = gzip.open(Fasta, 'wb', compresslevel=compresslevel)
+        else:
+            out_hd = open(Fasta, 'wb', buffering=4194304)
+        
+        with out_hd, concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            ## keep a fixed number of files read ahead
+            pending = []
+            for file_given in list_files:
+                pending.append((file_given, executor.submit(_prefetch_file, file_given)))
+                if len(pending) > threads:
+                    file_read, future = pending.pop(0)
+                    _write_fasta_file(out_hd, future.result(), file_read, prefix, dedup_headers, seen_ids)
+            
+            for file_read, future in pending:
+                _write_fasta_file(out_hd, future.result(), file_read, prefix, dedup_headers, seen_ids)
+    
+    except (OSError, EOFError) as err:
+        print (colored("** ERROR **", 'red'))
+        print (colored("concat_fasta():: %s" % err, 'red'))
+        print (colored("** ERROR **", 'red'))
+        return ('FAIL')
+    
+    return ('OK')
+
+def _prefetch_file(file_given, block_size=4194304, max_blocks=2):
+    """Opens a plain or gzip file and reads its first blocks. Returns the blocks and the handle (None if finished)."""
+    fh = gzip.open(file_given, 'rb') if file_given.endswith('.gz') else open(file_given, 'rb')
+    try:
+        blocks = []
+        for i in range(max_blocks):
+            block = fh.read(block_size)
+            if not block:
+                fh.close()
+                return (blocks, None)
+            blocks.append(block)
+        return (blocks, fh)
+    except BaseException:
+        fh.close()
+        raise
+
+def _write_fasta_file(out_hd, prefetched, file_given, prefix, dedup_headers, seen_ids, block_size=4194304):
+    """Writes blocks read ahead and the rest of the file, modifying headers if required."""
+    blocks, fh = prefetched
+    if fh is not None:
+        blocks = itertools.chain(blocks, iter(lambda: fh.read(block_size), b''))
+    try:
+        if prefix or dedup_headers:
+            _write_fasta_renamed(out_hd, blocks, file_given, prefix, dedup_headers, seen_ids)
+        else:
+            last = b'\n'
+            for block in blocks:
+                out_hd.write(block)
+                last = block[-1:]
+            if last != b'\n':
+                out_hd.write(b'\n')
+    finally:
+        if fh is not None:
+            fh.close()
+
+def _write_fasta_renamed(out_hd, blocks, file_given, prefix, dedup_headers, seen_ids):
+    """Writes fasta blocks provided rewriting headers. Only the header being read is kept in memory."""
+    name = os.path.basename(file_given)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    name = os.path.splitext(name)[0].encode()
+    
+    def new_header(header):
+        if prefix:
+            header = name + b'_' + header
+        if dedup_headers:
+            fields = header.split(None, 1) or [b'']
+            seq_id = fields[0]
+            seen_ids[seq_id] += 1
+            if seen_ids[seq_id] > 1:
+                fields[0] = seq_id + b'_' + str(seen_ids[seq_id]).encode()
+                header = b' '.join(fields)
+        return b'>' + header + b'\n'
+    
+    header = None ## partial header line
+    line_start = True
+    for block in blocks:
+        pos = 0
+        while pos < len(block):
+            if header is not None:
+                end = block.find(b'\n', pos)
+                if end < 0:
+                    header += block[pos:]
+                    break
+                out_hd.write(new_header(header + block[pos:end]))
+                header = None
+                line_start = True
+                pos = end + 1
+            elif line_start and block[pos] == 62: ## '>'
+                header = b''
+                pos += 1
+            else:
+                ## sequence lines until next header
+                end = block.find(b'\n>', pos)
+                if end < 0:
+                    out_hd.write(block[pos:])
+                    line_start = block.endswith(b'\n')
+                    break
+                out_hd.write(block[pos:end + 1])
+                line_start = True
+                pos = end + 1
+    
+    if header is not None:
+        out_hd.write(new_header(header))
+    elif not line_start:
+        out_hd.write(b'\n')
 
 ###############
 def subset_fasta(ident, fasta, out):
@@ -73,6 +225,179 @@ def subset_fasta(ident, fasta, out):
     
     output_FASTA.close()
 
+###############
+def open_file(file_name, mode='r'):
+    """Opens file provided in text mode. If file ends with .gz, it is opened using gzip."""
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't')
+    return open(file_name, mode)
+
+###############
+def fasta_iterator(fasta_file):
+    """
+    Generator function to iterate over FASTA records without creating Biopython objects.
+    
+    Sequences split along several lines are joined.
+    
+    :param fasta_file: Absolute path to fasta file (plain or gzip compressed).
+    :type fasta_file: string
+    
+    :returns: Tuples of (header, sequence). Header does not include the '>' character.
+    """
+    with open_file(fasta_file) as fh:
+        header = None
+        seq_lines = []
+        for line in fh:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield (header, "".join(seq_lines))
+                header = line[1:]
+                seq_lines = []
+            elif line:
+                seq_lines.append(line)
+        
+        if header is not None:
+            yield (header, "".join(seq_lines))
+
+###############
+def build_automaton(patterns):
+    """
+    Builds an Aho-Corasick automaton for the list of patterns provided.
+    
+    :param patterns: List of strings to search.
+    :type patterns: list
+    
+    :returns: Tuple of (goto, fail, output) lists, where goto contains a dictionary of transitions for each state,
+     fail contains the failure link for each state and output the patterns ending in each state.
+    """
+    goto = [{}]
+    fail = [0]
+    output = [[]]
+    
+    ## trie of patterns
+    for pattern in patterns:
+        state = 0
+        for char in pattern:
+            if char not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                output.append([])
+                goto[state][char] = len(goto) - 1
+            state = goto[state][char]
+        output[state].append(pattern)
+    
+    ## failure links: breadth first
+    queue = list(goto[0].values())
+    for state in queue:
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0)
+            output[next_state] = output[next_state] + output[fail[next_state]]
+    
+    return (goto, fail, output)
+
+###############
+def search_automaton(automaton, text):
+    """
+    Returns the set of patterns of the Aho-Corasick automaton found in text provided.
+    
+    :param automaton: Automaton generated by :func:`build_automaton`.
+    :param text: String to search.
+    :type text: string
+    
+    :returns: Set of patterns found.
+    """
+    goto, fail, output = automaton
+    found = set()
+    state = 0
+    for char in text:
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        if output[state]:
+            found.update(output[state])
+    return found
+
+###############
+def subset_fasta_ids(ids, fasta, out, substring=False, per_id=False, max_handles=256):
+    """
+    Subsets fasta file provided for a collection of identifiers in a single pass.
+    
+    By default, the identifier of each record (first word of the header) is searched using a set of exact ids.
+    If substring option provided, all ids are searched along the whole header description using an
+    Aho-Corasick automaton, so no regular expression is compiled for each of them.
+    
+    :param ids: Collection of identifiers or substrings to retrieve.
+    :param fasta: Absolute path to fasta file (plain or gzip compressed).
+    :param out: Absolute path for the output fasta file. If per_id provided, folder to store a file per identifier.
+    :param substring: True/False for searching ids as substrings of the header.
+    :param per_id: True/False for generating a fasta file for each identifier.
+    :param max_handles: Maximum number of output files kept open at the same time when per_id is provided.
+    
+    :type ids: list
+    :type fasta: string
+    :type out: string
+    :type substring: bool
+    :type per_id: bool
+    :type max_handles: int
+    
+    :returns: Dictionary containing the number of sequences retrieved for each identifier.
+    """
+    ids = set(ids)
+    count_ids = defaultdict(int)
+    
+    if substring:
+        automaton = build_automaton(ids)
+    
+    if per_id:
+        if not os.path.isdir(out):
+            os.makedirs(out)
+        handles = {}
+        created = set()
+    else:
+        output_FASTA = open_file(out, 'w')
+    
+    for header, seq in fasta_iterator(fasta):
+        if substring:
+            found = search_automaton(automaton, header)
+        else:
+            seq_id = header.split()[0] if header else header
+            found = [seq_id] if seq_id in ids else []
+        
+        if not found:
+            continue
+        
+        record = ">" + header + "\n" + seq + "\n"
+        if not per_id:
+            output_FASTA.write(record)
+        
+        for ident in found:
+            count_ids[ident] += 1
+            if per_id:
+                if ident not in handles:
+                    ## avoid exceeding the number of open files
+                    if len(handles) >= max_handles:
+                        for fh in handles.values():
+                            fh.close()
+                        handles = {}
+                    
+                    file_name = os.path.join(out, re.sub(r'[^\w\.\-]', '_', ident) + '.fasta')
+                    handles[ident] = open(file_name, 'a' if ident in created else 'w')
+                    created.add(ident)
+                handles[ident].write(record)
+    
+    if per_id:
+        for fh in handles.values():
+            fh.close()
+    else:
+        output_FASTA.close()
+    
+    return (count_ids)
+
 ###############
 def rename_fasta_seqs(fasta_file, name, new_fasta):
     """Rename fasta sequences provided in file :file:`fasta_file` using id :file:`name`. Save results in file :file:`new_fasta` provided.
@@ -91,33 +416,576 @@ def rename_fasta_seqs(fasta_file, name, new_fasta):
     .. include:: ../../links.inc         
     """
 
-    output_FASTA = open(new_fasta, 'w')
-    id_conversion = open(new_fasta + "_conversionID.txt", 'w')
-    
     if len(name) > 37:
         print (colored("** ERROR **", 'red'))
         print (colored("rename_fasta_seqs():: name id is > 37 characters.", 'red'))
         print (colored("** ERROR **", 'red'))
         return ('FAIL')
     
+    output_FASTA = open(new_fasta, 'w', buffering=1048576)
+    id_conversion = open(new_fasta + "_conversionID.txt", 'w', buffering=1048576)
+    
     counter_seqs = 0
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        old_id = record.description
+    for old_id, seq in fasta_iterator(fasta_file):
         counter_seqs += 1
         new_id = name + "_" + str(counter_seqs)
-        head = ">" + new_id + "\n"
-        output_FASTA.write(head)
-        output_FASTA.write(str(record.seq))
-        output_FASTA.write("\n")
-        
-        id_conversion.write(old_id + "\t" + new_id)
-        id_conversion.write("\n")
+        output_FASTA.write(">" + new_id + "\n" + seq + "\n")
+        id_conversion.write(old_id + "\t" + new_id + "\n")
     
     output_FASTA.close()
     id_conversion.close()
         
     return (new_fasta + "_conversionID.txt")
 
+###############
+def rename_fasta_seqs_batch(jobs, threads=2, merged_table=None):
+    """Rename fasta sequences for a list of files using a pool of processes. 
+    
+    Each job is processed using :func:`rename_fasta_seqs`.
+    
+    If :file:`merged_table` provided, all conversion tables are merged into a single tab delimited file 
+    (new id, old id, fasta file) and an index file (:file:`merged_table`.idx) is created containing, for 
+    each name, the byte offset and number of lines of its block within the merged file.
+    
+    :param jobs: List of (fasta_file, name, new_fasta) tuples.
+    :param threads: Number of processes to use.
+    :param merged_table: Absolute path for the merged conversion table. 
+    
+    :type jobs: list
+    :type threads: int
+    :type merged_table: string
+    
+    :returns: Dictionary containing for each new fasta file the path to its conversion table (or FAIL).
+    """
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        commandsSent = { executor.submit(rename_fasta_seqs, fasta_file, name, new_fasta): (fasta_file, name, new_fasta) 
+                        for fasta_file, name, new_fasta in jobs }
+        for cmd2 in concurrent.futures.as_completed(commandsSent):
+            details = commandsSent[cmd2]
+            try:
+                results[details[2]] = cmd2.result()
+            except Exception as exc:
+                print ('***ERROR:')
+                print('%r generated an exception: %s' % (details, exc))
+                results[details[2]] = 'FAIL'
+    
+    if merged_table:
+        with open(merged_table, 'w', buffering=1048576) as merged_hd, open(merged_table + '.idx', 'w') as index_hd:
+            offset = 0
+            for fasta_file, name, new_fasta in jobs:
+                if results[new_fasta] == 'FAIL':
+                    continue
+                
+                block = []
+                with open(results[new_fasta]) as table_hd:
+                    for line in table_hd:
+                        old_id, new_id = line.rstrip('\n').split('\t')
+                        block.append(new_id + "\t" + old_id + "\t" + fasta_file + "\n")
+                
+                block = "".join(block)
+                merged_hd.write(block)
+                index_hd.write("%s\t%s\t%s\n" % (name, offset, len(block.splitlines())))
+                offset += len(block.encode())
+    
+    return (results)
+
+###############
+def gc_profile(fasta_file, out, window=1000, step=None, out_format='bed', metric='gc'):
+    """
+    Computes GC content, GC skew and N content along sliding windows for each sequence.
+    
+    Each sequence is converted once into NumPy arrays and counts for each window are 
+    obtained using cumulative sums over blocks of ``step`` bases. Window must be a multiple of step.
+    
+    GC content is calculated over non-N bases, GC skew as (G-C)/(G+C) and N content over all bases.
+    
+    :param fasta_file: Absolute path to fasta file (plain or gzip compressed).
+    :param out: Absolute path for the output file.
+    :param window: Window size (bp).
+    :param step: Step size (bp). By default, non overlapping windows (step = window).
+    :param out_format: bed (chrom, start, end, gc, gc_skew, n_content) or bedgraph (single metric).
+    :param metric: Metric to report in bedgraph format: gc, skew or n.
+    
+    :type fasta_file: string
+    :type out: string
+    :type window: int
+    :type step: int
+    :type out_format: string
+    :type metric: string
+    
+    :returns: Number of windows reported.
+    """
+    if not step:
+        step = window
+    if window % step:
+        raise ValueError("gc_profile():: window (%s) must be a multiple of step (%s)" % (window, step))
+    if out_format not in ('bed', 'bedgraph'):
+        raise ValueError("gc_profile():: format %s not supported (bed/bedgraph)" % out_format)
+    if out_format == 'bedgraph' and metric not in ('gc', 'skew', 'n'):
+        raise ValueError("gc_profile():: metric %s not supported (gc/skew/n)" % metric)
+    
+    blocks_window = window // step
+    count_windows = 0
+    with open(out, 'w', buffering=4194304) as out_hd:
+        if out_format == 'bedgraph':
+            out_hd.write('track type=bedGraph name="%s" description="%s in %s bp windows"\n' % (metric, metric, window))
+        
+        for header, seq in fasta_iterator(fasta_file):
+            chrom = header.split()[0] if header else header
+            length = len(seq)
+            if not length:
+                continue
+            
+            bases = np.frombuffer(seq.encode(), dtype=np.uint8) & 0xDF ## uppercase
+            block_starts = np.arange(0, length, step)
+            
+            g = _cumulative_blocks(bases == ord('G'), block_starts)
+            c = _cumulative_blocks(bases == ord('C'), block_starts)
+            n = _cumulative_blocks(bases == ord('N'), block_starts)
+            
+            ## windows starting at each block; skip windows contained in the previous one
+            starts = block_starts[(block_starts == 0) | (block_starts + window - step < length)]
+            first = starts // step
+            last = np.minimum(first + blocks_window, len(block_starts))
+            ends = np.minimum(starts + window, length)
+            
+            g_win = g[last] - g[first]
+            c_win = c[last] - c[first]
+            n_win = n[last] - n[first]
+            size = ends - starts
+            
+            gc = (g_win + c_win) / np.maximum(size - n_win, 1)
+            skew = (g_win - c_win) / np.maximum(g_win + c_win, 1)
+            n_content = n_win / size
+            
+            if out_format == 'bed':
+                rows = zip(starts.tolist(), ends.tolist(), np.round(gc, 4).tolist(), 
+                           np.round(skew, 4).tolist(), np.round(n_content, 4).tolist())
+                out_hd.write("".join("%s\t%s\t%s\t%s\t%s\t%s\n" % (chrom, a, b, x, y, z) for a, b, x, y, z in rows))
+            else:
+                values = {'gc': gc, 'skew': skew, 'n': n_content}[metric]
+                rows = zip(starts.tolist(), ends.tolist(), np.round(values, 4).tolist())
+                out_hd.write("".join("%s\t%s\t%s\t%s\n" % (chrom, a, b, x) for a, b, x in rows))
+            
+            count_windows += len(starts)
+    
+    return (count_windows)
+
+def _cumulative_blocks(mask, block_starts):
+    """Returns cumulative counts of True values for blocks starting at the positions provided."""
+    return np.concatenate(([0], np.cumsum(np.add.reduceat(mask, block_starts, dtype=np.int64))))
+
+#################################
+###      Packed sequences      ##
+#################################
+
+## 2-bit codes: A:0, C:1, G:2, T:3; any other character: 255
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[base + 32] = code ## lowercase
+CODE_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+###############
+def encode_2bit(seq):
+    """
+    Converts a nucleotide sequence into an array of 2-bit codes (A:0, C:1, G:2, T:3).
+    
+    Any other character (N, IUPAC codes...) is coded as 255.
+    
+    :param seq: Nucleotide sequence.
+    :type seq: string or bytes
+    
+    :returns: NumPy uint8 array.
+    """
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+###############
+class PackedSeqStore:
+    """
+    Compact in-memory store for large collections of nucleotide sequences.
+    
+    Sequences are packed using 2 bits per base (4 bases per byte) in a contiguous NumPy buffer 
+    with an offset table. Characters other than ACGT (N, IUPAC codes) are stored as runs in an 
+    exception list. Sequences are stored in uppercase.
+    
+    Sequences, or slices of them, are decoded on demand:
+    
+        store = PackedSeqStore.from_fasta(fasta_file)
+        store.get('contig_1', 100, 200)
+    
+    :param names: Sequence names in the order added.
+    """
+    
+    def __init__(self):
+        """Initialize empty store"""
+        self.names = []
+        self._index = {}
+        self._pending = []
+        self._pending_exc = []
+        self._buffer = np.zeros(0, dtype=np.uint8)
+        self._offsets = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int64)
+        self._exc_offsets = np.zeros(1, dtype=np.int64)
+        self._exc_start = np.zeros(0, dtype=np.int64)
+        self._exc_end = np.zeros(0, dtype=np.int64)
+        self._exc_char = np.zeros(0, dtype=np.uint8)
+    
+    @classmethod
+    def from_fasta(cls, fasta_file):
+        """Creates a store containing all sequences of the fasta file provided (plain or gzip compressed)."""
+        store = cls()
+        for header, seq in fasta_iterator(fasta_file):
+            store.add(header.split()[0] if header else header, seq)
+        store._consolidate()
+        return store
+    
+    def add(self, name, seq):
+        """Adds sequence provided to the store."""
+        if name in self._index:
+            raise KeyError("PackedSeqStore:: duplicated sequence name %s" % name)
+        
+        if isinstance(seq, str):
+            seq = seq.encode()
+        raw = np.frombuffer(seq, dtype=np.uint8)
+        codes = BASE_CODES[raw]
+        
+        ## store non ACGT characters as runs of the same character
+        invalid = np.flatnonzero(codes == 255)
+        if len(invalid):
+            chars = raw[invalid]
+            chars = np.where((chars >= 97) & (chars <= 122), chars - 32, chars).astype(np.uint8) ## uppercase letters only
+            breaks = np.flatnonzero((np.diff(invalid) != 1) | (np.diff(chars) != 0)) + 1
+            starts = np.concatenate(([0], breaks))
+            ends = np.concatenate((breaks, [len(invalid)]))
+            self._pending_exc.append((invalid[starts], invalid[ends - 1] + 1, chars[starts]))
+            codes = np.where(codes == 255, 0, codes).astype(np.uint8)
+        else:
+            self._pending_exc.append(None)
+        
+        ## pack 4 bases per byte, first base in the highest bits
+        padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+        padded[:len(codes)] = codes
+        padded = padded.reshape(-1, 4)
+        packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) | (padded[:, 2] << 2) | padded[:, 3]
+        
+        self._index[name] = len(self.names)
+        self.names.append(name)
+        self._pending.append((packed, len(codes)))
+    
+    def _consolidate(self):
+        """Moves sequences added into the contiguous buffers."""
+        if not self._pending:
+            return
+        
+        lengths = np.array([length for packed, length in self._pending], dtype=np.int64)
+        sizes = np.array([len(packed) for packed, length in self._pending], dtype=np.int64)
+        offsets = len(self._buffer) + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        
+        self._buffer = np.concatenate([self._buffer] + [packed for packed, length in self._pending])
+        self._offsets = np.concatenate((self._offsets, offsets))
+        self._lengths = np.concatenate((self._lengths, lengths))
+        
+        exc_counts = np.array([len(exc[0]) if exc else 0 for exc in self._pending_exc], dtype=np.int64)
+        self._exc_offsets = np.concatenate((self._exc_offsets, self._exc_offsets[-1] + np.cumsum(exc_counts)))
+        exc_list = [exc for exc in self._pending_exc if exc]
+        if exc_list:
+            self._exc_start = np.concatenate([self._exc_start] + [exc[0] for exc in exc_list])
+            self._exc_end = np.concatenate([self._exc_end] + [exc[1] for exc in exc_list])
+            self._exc_char = np.concatenate([self._exc_char] + [exc[2] for exc in exc_list])
+        
+        self._pending = []
+        self._pending_exc = []
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __contains__(self, name):
+        return name in self._index
+    
+    def __iter__(self):
+        return iter(self.names)
+    
+    def __getitem__(self, name):
+        return self.get(name)
+    
+    def length(self, name):
+        """Returns the length of the sequence provided."""
+        self._consolidate()
+        return int(self._lengths[self._index[name]])
+    
+    def nbytes(self):
+        """Returns the number of bytes used by the sequence buffers."""
+        self._consolidate()
+        return (self._buffer.nbytes + self._offsets.nbytes + self._lengths.nbytes + self._exc_offsets.nbytes +
+                self._exc_start.nbytes + self._exc_end.nbytes + self._exc_char.nbytes)
+    
+    def get(self, name, start=0, end=None):
+        """
+        Decodes sequence (or slice) provided.
+        
+        :param name: Sequence name.
+        :param start: 0-based start position.
+        :param end: End position (not included). By default, end of sequence.
+        
+        :returns: Sequence string.
+        """
+        self._consolidate()
+        i = self._index[name]
+        length = int(self._lengths[i])
+        start, end, step = slice(start, end).indices(length)
+        if end <= start:
+            return ''
+        
+        ## unpack bytes covering the slice
+        first = int(self._offsets[i]) + start // 4
+        last = int(self._offsets[i]) + -(-end // 4)
+        packed = self._buffer[first:last]
+        codes = ((packed[:, None] >> np.array([6, 4, 2, 0], dtype=np.uint8)) & 3).ravel()
+        skip = start % 4
+        seq = CODE_BASES[codes[skip:skip + end - start]]
+        
+        ## restore exceptions overlapping the slice
+        exc_first, exc_last = self._exc_offsets[i], self._exc_offsets[i + 1]
+        if exc_last > exc_first:
+            exc_start = self._exc_start[exc_first:exc_last]
+            exc_end = self._exc_end[exc_first:exc_last]
+            exc_char = self._exc_char[exc_first:exc_last]
+            for j in np.flatnonzero((exc_start < end) & (exc_end > start)):
+                seq[max(exc_start[j], start) - start:min(exc_end[j], end) - start] = exc_char[j]
+        
+        return seq.tobytes().decode()
+
+#################################
+###     Sequence digests       ##
+#################################
+
+###############
+def seq_digest(seq):
+    """Returns a 128-bit digest (blake2b, 16 bytes) of the uppercase sequence provided."""
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return hashlib.blake2b(seq.upper(), digest_size=16).digest()
+
+###############
+def digests2array(digests):
+    """Converts a list of 128-bit digests into a NumPy array of two uint64 columns (high, low)."""
+    return np.frombuffer(b''.join(digests), dtype='>u8').reshape(-1, 2)
+
+###############
+class SeqDigestIndex:
+    """
+    Sequence to name lookup index keyed by 128-bit digests of each sequence.
+    
+    It replaces a dictionary of full sequences (see :func:`get_fasta_dict`) with two sorted 
+    NumPy uint64 arrays, so memory does not grow with sequence length. The first 64 bits are 
+    searched using ``searchsorted`` and the second 64 bits select among entries sharing them. Both 
+    halves belong to the same digest, so by default a match relies on the whole 128-bit key and 
+    sequences are not compared. If several sequences are identical, the first name is kept.
+    
+    If the index is created from an uncompressed fasta file, the byte offset of each sequence is 
+    stored, and ``lookup(seqs, verify=True)`` compares each match with the reference sequence.
+    
+    :param names: Sequence names sorted by digest.
+    :param fasta_file: Reference fasta file (only for indexes with offsets).
+    :param offsets: Byte offset of each sequence in the reference fasta file, or None.
+    """
+    
+    def __init__(self, names=None, digests=None, fasta_file=None, offsets=None):
+        """Initialize index with names, digest array (see :func:`digests2array`) and offsets provided."""
+        if names is None:
+            names = []
+            digests = np.zeros((0, 2), dtype='>u8')
+        
+        hi = digests[:, 0].astype(np.uint64)
+        lo = digests[:, 1].astype(np.uint64)
+        order = np.lexsort((lo, hi))
+        hi, lo = hi[order], lo[order]
+        
+        ## keep first sequence of identical ones
+        keep = np.ones(len(hi), dtype=np.bool_)
+        keep[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+        keep_order = order[keep]
+        self.names = [names[i] for i in keep_order]
+        self._hi = hi[keep]
+        self._lo = lo[keep]
+        self.fasta_file = fasta_file
+        self.offsets = None if offsets is None else np.asarray(offsets, dtype=np.int64)[keep_order]
+    
+    @classmethod
+    def from_fasta(cls, fasta_file):
+        """
+        Creates the index for all sequences in the fasta file provided (plain or gzip compressed).
+        
+        For uncompressed files, sequence offsets are stored for verification.
+        """
+        names = []
+        digests = []
+        if fasta_file.endswith('.gz'):
+            for header, seq in fasta_iterator(fasta_file):
+                names.append(header)
+                digests.append(seq_digest(seq))
+            return cls(names, digests2array(digests))
+        
+        offsets = []
+        for offset, header, seq in _fasta_offsets_iterator(fasta_file):
+            names.append(header)
+            digests.append(seq_digest(seq))
+            offsets.append(offset)
+        return cls(names, digests2array(digests), os.path.abspath(fasta_file), offsets)
+    
+    @classmethod
+    def load(cls, index_file):
+        """Loads an index saved using :func:`SeqDigestIndex.save`."""
+        data = np.load(index_file, allow_pickle=False)
+        index = cls()
+        index.names = data['names'].tolist()
+        index._hi = data['hi']
+        index._lo = data['lo']
+        if 'offsets' in data:
+            index.fasta_file = str(data['fasta_file'])
+            index.offsets = data['offsets']
+        return index
+    
+    def save(self, index_file):
+        """Saves index in NumPy .npz format."""
+        arrays = {'names': np.array(self.names, dtype=str), 'hi': self._hi, 'lo': self._lo}
+        if self.offsets is not None:
+            arrays['fasta_file'] = np.array(self.fasta_file, dtype=str)
+            arrays['offsets'] = self.offsets
+        np.savez(index_file, **arrays)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def lookup_digests(self, digests):
+        """
+        Searches array of digests (see :func:`digests2array`) in the index.
+        
+        :returns: NumPy array of positions in :attr:`names` for each digest (-1 if not found).
+        """
+        hi = digests[:, 0].astype(np.uint64)
+        lo = digests[:, 1].astype(np.uint64)
+        
+        ## search high bits; several entries might share them
+        left = np.searchsorted(self._hi, hi, side='left')
+        right = np.searchsorted(self._hi, hi, side='right')
+        pos = np.full(len(hi), -1, dtype=np.int64)
+        if not len(self._lo):
+            return pos
+        
+        match = ((right - left) == 1) & (self._lo[np.minimum(left, len(self._lo) - 1)] == lo)
+        pos[match] = left[match]
+        
+        ## select low bits among entries sharing the high bits
+        for i in np.flatnonzero((right - left) > 1):
+            found = np.flatnonzero(self._lo[left[i]:right[i]] == lo[i])
+            if len(found):
+                pos[i] = left[i] + found[0]
+        
+        return pos
+    
+    def lookup(self, seqs, verify=False):
+        """
+        Searches batch of sequences in the index.
+        
+        :param seqs: List of sequences.
+        :param verify: True/False for comparing each match with the reference sequence (requires offsets).
+        :type seqs: list
+        :type verify: bool
+        
+        :returns: List of names (None if sequence not found).
+        """
+        if verify and self.offsets is None:
+            raise ValueError("SeqDigestIndex.lookup():: verification requires an index created from an uncompressed fasta file")
+        if not len(seqs):
+            return []
+        pos = self.lookup_digests(digests2array([seq_digest(seq) for seq in seqs]))
+        
+        if verify:
+            with open(self.fasta_file, 'rb') as fh:
+                for i in np.flatnonzero(pos >= 0).tolist():
+                    seq = seqs[i].encode() if isinstance(seqs[i], str) else bytes(seqs[i])
+                    if _read_fasta_seq(fh, int(self.offsets[pos[i]])).upper() != seq.upper():
+                        pos[i] = -1
+        
+        return [self.names[p] if p >= 0 else None for p in pos.tolist()]
+
+def _fasta_offsets_iterator(fasta_file):
+    """Yields (offset, header, sequence) for each record of an uncompressed fasta file."""
+    with open(fasta_file, 'rb') as fh:
+        offset = 0
+        record = None
+        for line in fh:
+            stripped = line.rstrip()
+            if stripped.startswith(b'>'):
+                if record is not None:
+                    yield (record[0], record[1], b''.join(record[2]))
+                record = (offset, stripped[1:].decode(), [])
+            elif record is not None:
+                record[2].append(stripped)
+            offset += len(line)
+        if record is not None:
+            yield (record[0], record[1], b''.join(record[2]))
+
+def _read_fasta_seq(fh, offset):
+    """Returns the sequence (bytes) of the fasta record starting at the offset provided."""
+    fh.seek(offset)
+    fh.readline()
+    seq_lines = []
+    for line in fh:
+        if line.startswith(b'>'):
+            break
+        seq_lines.append(line.rstrip())
+    return b''.join(seq_lines)
+
+###############
+def dedup_fasta(fasta_files, out, mapping):
+    """
+    Removes duplicated sequences across several fasta files.
+    
+    Files are streamed and each sequence (uppercase) is hashed using :func:`seq_digest`, so only 
+    digests and ids of the sequences kept are stored in memory. The first occurrence of each 
+    sequence is kept. 
+    
+    :param fasta_files: List of absolute paths to fasta files (plain or gzip compressed).
+    :param out: Absolute path for the non-redundant fasta file. If it ends with .gz, output is compressed.
+    :param mapping: Absolute path for a tab delimited file with the header removed, the header kept and the file of the removed sequence.
+    
+    :type fasta_files: list
+    :type out: string
+    :type mapping: string
+    
+    :returns: Dictionary with the number of sequences, unique sequences and duplicates removed.
+    """
+    kept = {}
+    stats = {'sequences': 0, 'unique': 0, 'duplicated': 0}
+    with BlockWriter(out) as writer, open(mapping, 'w', buffering=1048576) as mapping_hd:
+        mapping_hd.write("#removed\tkept\tfile\n")
+        buffer = []
+        for fasta_file in fasta_files:
+            for header, seq in fasta_iterator(fasta_file):
+                stats['sequences'] += 1
+                digest = seq_digest(seq)
+                if digest in kept:
+                    stats['duplicated'] += 1
+                    mapping_hd.write("%s\t%s\t%s\n" % (header, kept[digest], fasta_file))
+                    continue
+                
+                kept[digest] = header.split()[0] if header else header
+                stats['unique'] += 1
+                buffer.append(">" + header + "\n" + seq + "\n")
+                if len(buffer) == 10000:
+                    writer.write("".join(buffer).encode())
+                    buffer = []
+        
+        writer.write("".join(buffer).encode())
+    
+    return (stats)
+
 ### 
 def process_fasta(lines):
     ks = ['name', 'sequence']
@@ -128,6 +996,543 @@ def process_fastq(lines):
     ks = ['name', 'sequence', 'optional', 'quality']
     return {k: v for k, v in zip(ks, lines)}
 
+#################################
+###         FASTQ files        ##
+#################################
+
+###############
+def block_reader(file_name, block_size=4194304, queue_size=4):
+    """
+    Generator function that reads binary blocks of the file provided.
+    
+    Reading and decompression (if file ends with .gz) is done in a background thread, 
+    so parsing of a block overlaps with decompression of the next one.
+    
+    :param file_name: Absolute path to file (plain or gzip compressed).
+    :param block_size: Number of bytes for each block.
+    :param queue_size: Maximum number of blocks read ahead.
+    
+    :type file_name: string
+    :type block_size: int
+    :type queue_size: int
+    
+    :returns: Binary blocks (bytes).
+    """
+    blocks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    
+    def reader():
+        try:
+            if file_name.endswith('.gz'):
+                fh = gzip.open(file_name, 'rb')
+            else:
+                fh = open(file_name, 'rb')
+            with fh:
+                while not stop.is_set():
+                    block = fh.read(block_size)
+                    if not block:
+                        break
+                    blocks.put(block)
+            blocks.put(None)
+        except Exception as err:
+            blocks.put(err)
+    
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        ## release reader thread if generator is closed before the end
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+###############
+class BlockWriter:
+    """
+    Writes binary blocks into a file using a background thread.
+    
+    If file name ends with .gz, output is compressed, so compression overlaps with the 
+    processing of the next block. It can be used as a context manager:
+    
+        with BlockWriter(out_file) as writer:
+            writer.write(block)
+    
+    :param file_name: Absolute path to output file.
+    :param queue_size: Maximum number of blocks waiting to be written.
+    :param compresslevel: Compression level for gzip output.
+    """
+    
+    def __init__(self, file_name, queue_size=4, compresslevel=6):
+        """Initialize writer and start background thread"""
+        self.file_name = file_name
+        self._blocks = queue.Queue(maxsize=queue_size)
+        self._error = None
+        if file_name.endswith('.gz'):
+            self._fh = gzip.open(file_name, 'wb', compresslevel=compresslevel)
+        else:
+            self._fh = open(file_name, 'wb')
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+    
+    def _writer(self):
+        try:
+            with self._fh:
+                while True:
+                    block = self._blocks.get()
+                    if block is None:
+                        break
+                    self._fh.write(block)
+        except Exception as err:
+            self._error = err
+            ## keep consuming to avoid blocking main thread
+            while self._blocks.get() is not None:
+                pass
+    
+    def write(self, block):
+        """Adds block (bytes) to the writing queue."""
+        if self._error:
+            raise self._error
+        if block:
+            self._blocks.put(block)
+    
+    def close(self):
+        """Writes pending blocks and closes file."""
+        if self._thread.is_alive():
+            self._blocks.put(None)
+            self._thread.join()
+        if self._error:
+            raise self._error
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+###############
+def fastq_iterator(fastq_file, block_size=4194304):
+    """
+    Generator function to iterate over FASTQ records.
+    
+    File is read in large binary blocks (see :func:`block_reader`) and each record is returned as 
+    ``memoryview`` slices of the block, so no string is created for each line. Use ``bytes()`` or 
+    ``str(x, 'ascii')`` to get a copy of any field.
+    
+    :param fastq_file: Absolute path to fastq file (plain or gzip compressed).
+    :param block_size: Number of bytes to read each time.
+    
+    :type fastq_file: string
+    :type block_size: int
+    
+    :returns: Tuples of (name, sequence, quality) as memoryview. Name does not include the '@' character.
+    """
+    leftover = b''
+    for block in _chain_eof(block_reader(fastq_file, block_size)):
+        buf = leftover + block if leftover else block
+        view = memoryview(buf)
+        find = buf.find
+        pos = 0
+        while True:
+            end_name = find(b'\n', pos)
+            if end_name < 0: break
+            end_seq = find(b'\n', end_name + 1)
+            if end_seq < 0: break
+            end_opt = find(b'\n', end_seq + 1)
+            if end_opt < 0: break
+            end_qual = find(b'\n', end_opt + 1)
+            if end_qual < 0: break
+            
+            if buf[pos] != 64: ## @
+                raise ValueError("fastq_iterator():: record does not start with '@' in file %s" % fastq_file)
+            
+            ## remove carriage return if any
+            end_seq_str = end_seq - 1 if buf[end_seq - 1] == 13 else end_seq
+            end_qual_str = end_qual - 1 if buf[end_qual - 1] == 13 else end_qual
+            end_name_str = end_name - 1 if buf[end_name - 1] == 13 else end_name
+            
+            if end_seq_str - end_name != end_qual_str - end_opt:
+                raise ValueError("fastq_iterator():: sequence and quality lengths differ in file %s" % fastq_file)
+            
+            yield (view[pos + 1:end_name_str], view[end_name + 1:end_seq_str], view[end_opt + 1:end_qual_str])
+            pos = end_qual + 1
+        
+        leftover = buf[pos:]
+    
+    if leftover.strip():
+        raise ValueError("fastq_iterator():: truncated record at the end of file %s" % fastq_file)
+
+def _chain_eof(blocks):
+    """Adds a final newline to the blocks provided, in case the last line is not finished."""
+    last = b''
+    for block in blocks:
+        yield block
+        last = block
+    if last and not last.endswith(b'\n'):
+        yield b'\n'
+
+###############
+def fastq_batch_iterator(fastq_file, batch_size=100000, phred_offset=33, block_size=4194304):
+    """
+    Generator function to iterate over batches of FASTQ records as NumPy arrays.
+    
+    Sequences and qualities are stored in 2D ``uint8`` arrays (one row per read) padded with zeros 
+    up to the longest read of the batch.
+    
+    :param fastq_file: Absolute path to fastq file (plain or gzip compressed).
+    :param batch_size: Number of reads for each batch.
+    :param phred_offset: Offset to substract to the quality ASCII characters.
+    :param block_size: Number of bytes to read each time.
+    
+    :type fastq_file: string
+    :type batch_size: int
+    :type phred_offset: int
+    :type block_size: int
+    
+    :returns: Dictionary with keys: names (list of bytes), lengths (int array), seq (ASCII codes) and qual (Phred scores).
+    """
+    names, seqs, quals = [], [], []
+    for name, seq, qual in fastq_iterator(fastq_file, block_size):
+        names.append(bytes(name))
+        seqs.append(seq)
+        quals.append(qual)
+        if len(names) == batch_size:
+            yield _fastq_batch(names, seqs, quals, phred_offset)
+            names, seqs, quals = [], [], []
+    
+    if names:
+        yield _fastq_batch(names, seqs, quals, phred_offset)
+
+###############
+def fastq_batch2bytes(batch, ends=None, keep=None, phred_offset=33):
+    """
+    Converts a batch of reads (see :func:`fastq_batch_iterator`) back into FASTQ format.
+    
+    :param batch: Dictionary of NumPy arrays for the batch of reads.
+    :param ends: Array of positions to cut each read. By default, the length of each read.
+    :param keep: Boolean array of reads to include. By default, all reads.
+    :param phred_offset: Offset to add to Phred scores.
+    
+    :returns: Bytes for the FASTQ records.
+    """
+    if ends is None:
+        ends = batch['lengths']
+    indexes = np.flatnonzero(keep) if keep is not None else range(len(batch['names']))
+    
+    seq = batch['seq']
+    qual = batch['qual'] + np.uint8(phred_offset)
+    names = batch['names']
+    records = []
+    for i, end in zip(indexes, np.asarray(ends)[indexes].tolist()):
+        records.append(b'@' + names[i] + b'\n' + seq[i, :end].tobytes() + b'\n+\n' + qual[i, :end].tobytes() + b'\n')
+    return b''.join(records)
+
+def _fastq_batch(names, seqs, quals, phred_offset):
+    """Converts list of reads into padded NumPy arrays."""
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    max_len = int(lengths.max()) if len(lengths) else 0
+    mask = np.arange(max_len) < lengths[:, None]
+    
+    seq_array = np.zeros((len(seqs), max_len), dtype=np.uint8)
+    seq_array[mask] = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    
+    qual_array = np.zeros((len(quals), max_len), dtype=np.uint8)
+    qual_array[mask] = np.frombuffer(b''.join(quals), dtype=np.uint8) - phred_offset
+    
+    return {'names': names, 'lengths': lengths, 'seq': seq_array, 'qual': qual_array}
+
+###############
+def fastq_qc_stats(fastq_file, out=None, out_format='json', batch_size=100000, phred_offset=33):
+    """
+    Computes basic quality control statistics for a FASTQ file in a single pass.
+    
+    Batches of reads (see :func:`fastq_batch_iterator`) are summarized using NumPy vectorized 
+    operations to obtain: number of reads and bases, length distribution, mean quality per position, 
+    GC content and N rate.
+    
+    :param fastq_file: Absolute path to fastq file (plain or gzip compressed).
+    :param out: Absolute path for the summary file. If not provided, no file is written.
+    :param out_format: Format for the summary file: json or tsv.
+    :param batch_size: Number of reads to process each time.
+    :param phred_offset: Offset of quality ASCII characters.
+    
+    :type fastq_file: string
+    :type out: string
+    :type out_format: string
+    :type batch_size: int
+    :type phred_offset: int
+    
+    :returns: Dictionary containing statistics.
+    """
+    if out and out_format not in ('json', 'tsv'):
+        raise ValueError("fastq_qc_stats():: format %s not supported (json/tsv)" % out_format)
+    
+    gc_table = np.zeros(256, dtype=np.bool_)
+    gc_table[np.frombuffer(b'GCSgcs', dtype=np.uint8)] = True
+    n_table = np.zeros(256, dtype=np.bool_)
+    n_table[np.frombuffer(b'Nn', dtype=np.uint8)] = True
+    
+    reads = 0
+    bases = 0
+    gc_bases = 0
+    n_bases = 0
+    qual_sum = 0
+    length_counts = np.zeros(0, dtype=np.int64)
+    pos_qual_sum = np.zeros(0, dtype=np.int64)
+    pos_counts = np.zeros(0, dtype=np.int64)
+    
+    for batch in fastq_batch_iterator(fastq_file, batch_size=batch_size, phred_offset=phred_offset):
+        lengths = batch['lengths']
+        seq = batch['seq']
+        qual = batch['qual']
+        
+        reads += len(lengths)
+        bases += int(lengths.sum())
+        gc_bases += int(np.count_nonzero(gc_table[seq]))
+        n_bases += int(np.count_nonzero(n_table[seq]))
+        
+        ## length distribution
+        batch_counts = np.bincount(lengths)
+        if len(batch_counts) > len(length_counts):
+            length_counts = np.pad(length_counts, (0, len(batch_counts) - len(length_counts)))
+        length_counts[:len(batch_counts)] += batch_counts
+        
+        ## quality per position: padding positions have 0 quality
+        batch_qual = qual.sum(axis=0, dtype=np.int64)
+        qual_sum += int(batch_qual.sum())
+        batch_pos = np.cumsum(batch_counts[::-1])[::-1][1:]
+        if len(batch_qual) > len(pos_qual_sum):
+            pos_qual_sum = np.pad(pos_qual_sum, (0, len(batch_qual) - len(pos_qual_sum)))
+            pos_counts = np.pad(pos_counts, (0, len(batch_qual) - len(pos_counts)))
+        pos_qual_sum[:len(batch_qual)] += batch_qual
+        pos_counts[:len(batch_pos)] += batch_pos
+    
+    pos_mean = pos_qual_sum / np.maximum(pos_counts, 1)
+    
+    stats = {
+        'file': fastq_file,
+        'reads': reads,
+        'bases': bases,
+        'min_length': int(np.flatnonzero(length_counts)[0]) if reads else 0,
+        'max_length': int(len(length_counts) - 1) if reads else 0,
+        'mean_length': round(bases / reads, 2) if reads else 0,
+        'mean_quality': round(qual_sum / bases, 2) if bases else 0,
+        'gc_content': round(100 * gc_bases / bases, 2) if bases else 0,
+        'n_rate': round(100 * n_bases / bases, 4) if bases else 0,
+        'length_distribution': {int(l): int(c) for l, c in enumerate(length_counts) if c},
+        'mean_quality_per_position': [round(float(q), 2) for q in pos_mean],
+    }
+    
+    if out:
+        if out_format == 'json':
+            with open(out, 'w') as out_hd:
+                json.dump(stats, out_hd, indent=4)
+        else:
+            with open(out, 'w') as out_hd:
+                for key, value in stats.items():
+                    if isinstance(value, dict):
+                        value = ",".join("%s:%s" % (k, v) for k, v in value.items())
+                    elif isinstance(value, list):
+                        value = ",".join(str(v) for v in value)
+                    out_hd.write("%s\t%s\n" % (key, value))
+    
+    return (stats)
+
+###############
+def subsample_fastq(fastq_file, out, number=None, fraction=None, fastq_file2=None, out2=None, seed=100):
+    """
+    Subsamples reads from a single or paired-end FASTQ file in a single pass.
+    
+    A fixed number of reads is retrieved using reservoir sampling (reads are kept in memory and 
+    written in the original order) and a fraction of reads using Bernoulli sampling. Pairs are 
+    read in lock-step so R1 and R2 are kept synchronised. If output file names end with .gz, 
+    output is compressed.
+    
+    :param fastq_file: Absolute path to fastq file (R1 for paired-end; plain or gzip compressed).
+    :param out: Absolute path for the subsampled fastq file.
+    :param number: Number of reads (or pairs) to retrieve.
+    :param fraction: Fraction of reads (or pairs) to retrieve (0-1).
+    :param fastq_file2: Absolute path to R2 fastq file for paired-end data.
+    :param out2: Absolute path for the subsampled R2 fastq file.
+    :param seed: Seed for the random generator, for reproducibility.
+    
+    :type fastq_file: string
+    :type out: string
+    :type number: int
+    :type fraction: float
+    :type fastq_file2: string
+    :type out2: string
+    :type seed: int
+    
+    :returns: Number of reads (or pairs) retrieved.
+    """
+    if (number is None) == (fraction is None):
+        raise ValueError("subsample_fastq():: provide either number or fraction of reads")
+    paired = bool(fastq_file2)
+    if paired and not out2:
+        raise ValueError("subsample_fastq():: out2 is required for paired-end data")
+    
+    rng = random.Random(seed)
+    records = _paired_records(fastq_file, fastq_file2)
+    
+    count = 0
+    ## writers are closed (and flushed) even if any of them fails to open
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(BlockWriter(out))
+        writer2 = stack.enter_context(BlockWriter(out2)) if paired else None
+        
+        if fraction is not None:
+            ## Bernoulli sampling
+            buffer, buffer2 = [], []
+            for record, record2 in records:
+                if rng.random() < fraction:
+                    buffer.append(record)
+                    buffer2.append(record2)
+                    count += 1
+                    if len(buffer) == 10000:
+                        writer.write(b''.join(buffer))
+                        if paired: writer2.write(b''.join(buffer2))
+                        buffer, buffer2 = [], []
+            writer.write(b''.join(buffer))
+            if paired: writer2.write(b''.join(buffer2))
+        
+        else:
+            ## reservoir sampling: keep index to restore original order
+            reservoir = []
+            for i, (record, record2) in enumerate(records):
+                if i < number:
+                    reservoir.append((i, record, record2))
+                else:
+                    j = rng.randint(0, i)
+                    if j < number:
+                        reservoir[j] = (i, record, record2)
+            
+            reservoir.sort(key=lambda x: x[0])
+            writer.write(b''.join(x[1] for x in reservoir))
+            if paired: writer2.write(b''.join(x[2] for x in reservoir))
+            count = len(reservoir)
+
+    return (count)
+
+def _paired_records(fastq_file, fastq_file2=None):
+    """Generator of FASTQ records (bytes) for single or paired-end files read in lock-step."""
+    reads = fastq_iterator(fastq_file)
+    reads2 = fastq_iterator(fastq_file2) if fastq_file2 else None
+    for name, seq, qual in reads:
+        record = b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n'
+        record2 = None
+        if reads2:
+            read2 = next(reads2, None)
+            if read2 is None:
+                raise ValueError("Different number of reads in %s and %s" % (fastq_file, fastq_file2))
+            record2 = b'@' + read2[0] + b'\n' + read2[1] + b'\n+\n' + read2[2] + b'\n'
+        yield (record, record2)
+    
+    if reads2 and next(reads2, None) is not None:
+        raise ValueError("Different number of reads in %s and %s" % (fastq_file, fastq_file2))
+
+###############
+def read_pair_id(name):
+    """Returns the read identifier (first word, without /1 or /2 suffix) for the read name provided (bytes)."""
+    name = bytes(name).split(None, 1)[0] if name else b''
+    if name[-2:] in (b'/1', b'/2'):
+        return name[:-2]
+    return name
+
+###############
+def interleave_fastq(fastq_R1, fastq_R2, out, check_names=True):
+    """
+    Interleaves paired-end FASTQ files into a single file (R1, R2, R1, R2...).
+    
+    Both files are read in lock-step using :func:`fastq_iterator` (threaded decompression) and 
+    output is compressed in a background thread if file name ends with .gz.
+    
+    :param fastq_R1: Absolute path to R1 fastq file (plain or gzip compressed).
+    :param fastq_R2: Absolute path to R2 fastq file (plain or gzip compressed).
+    :param out: Absolute path for the interleaved fastq file.
+    :param check_names: True/False for checking that read names of each pair match.
+    
+    :type fastq_R1: string
+    :type fastq_R2: string
+    :type out: string
+    :type check_names: bool
+    
+    :returns: Number of pairs.
+    """
+    reads2 = fastq_iterator(fastq_R2)
+    count = 0
+    buffer = []
+    with BlockWriter(out) as writer:
+        for name, seq, qual in fastq_iterator(fastq_R1):
+            read2 = next(reads2, None)
+            if read2 is None:
+                raise ValueError("interleave_fastq():: different number of reads in %s and %s" % (fastq_R1, fastq_R2))
+            if check_names and read_pair_id(name) != read_pair_id(read2[0]):
+                raise ValueError("interleave_fastq():: read names do not match: %s - %s" % (bytes(name).decode(), bytes(read2[0]).decode()))
+            
+            buffer.append(b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n' +
+                          b'@' + read2[0] + b'\n' + read2[1] + b'\n+\n' + read2[2] + b'\n')
+            count += 1
+            if len(buffer) == 10000:
+                writer.write(b''.join(buffer))
+                buffer = []
+        
+        writer.write(b''.join(buffer))
+        if next(reads2, None) is not None:
+            raise ValueError("interleave_fastq():: different number of reads in %s and %s" % (fastq_R1, fastq_R2))
+    
+    return (count)
+
+###############
+def deinterleave_fastq(fastq_file, out_R1, out_R2, check_names=True):
+    """
+    Splits an interleaved FASTQ file (R1, R2, R1, R2...) into paired-end files.
+    
+    :param fastq_file: Absolute path to interleaved fastq file (plain or gzip compressed).
+    :param out_R1: Absolute path for R1 fastq file. If it ends with .gz, output is compressed.
+    :param out_R2: Absolute path for R2 fastq file. If it ends with .gz, output is compressed.
+    :param check_names: True/False for checking that read names of each pair match.
+    
+    :type fastq_file: string
+    :type out_R1: string
+    :type out_R2: string
+    :type check_names: bool
+    
+    :returns: Number of pairs.
+    """
+    reads = fastq_iterator(fastq_file)
+    count = 0
+    buffer, buffer2 = [], []
+    with BlockWriter(out_R1) as writer, BlockWriter(out_R2) as writer2:
+        for name, seq, qual in reads:
+            read2 = next(reads, None)
+            if read2 is None:
+                raise ValueError("deinterleave_fastq():: odd number of reads in %s" % fastq_file)
+            if check_names and read_pair_id(name) != read_pair_id(read2[0]):
+                raise ValueError("deinterleave_fastq():: read names do not match: %s - %s" % (bytes(name).decode(), bytes(read2[0]).decode()))
+            
+            buffer.append(b'@' + name + b'\n' + seq + b'\n+\n' + qual + b'\n')
+            buffer2.append(b'@' + read2[0] + b'\n' + read2[1] + b'\n+\n' + read2[2] + b'\n')
+            count += 1
+            if len(buffer) == 10000:
+                writer.write(b''.join(buffer))
+                writer2.write(b''.join(buffer2))
+                buffer, buffer2 = [], []
+        
+        writer.write(b''.join(buffer))
+        writer2.write(b''.join(buffer2))
+    
+    return (count)
+
 #####
 def reads2tabular(fastq_file, out):
     
@@ -135,18 +1540,9 @@ def reads2tabular(fastq_file, out):
     freq_fasta = defaultdict(int)
     
     ## read fastq    
-    n = 4
-    with open(fastq_file, 'r') as fh:
-        lines = []
-        for line in fh:
-            lines.append(line.rstrip())
-            if len(lines) == n:
-                record = process_fastq(lines)
-                #sys.stderr.write("Record: %s\n" % (str(record)))
-                lines = []
-                
-                ## add sequences & count
-                freq_fasta[record['sequence']] += 1
+    for name, seq, qual in fastq_iterator(fastq_file):
+        ## add sequences & count
+        freq_fasta[str(seq, 'ascii')] += 1
 
     ## print in file
     with open(out,'w') as file:
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2020 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+K-mer counting functions used along ``BacterialTyper`` & ``XICRA`` pipeline.
+
+Sequences are 2-bit encoded into NumPy arrays and canonical k-mers (k up to 31)
+are obtained as 64-bit integers, counted using sort and unique.
+"""
+## useful imports
+import concurrent.futures
+import numpy as np
+
+from HCGB.functions import fasta_functions
+
+#################################
+###          K-mers            ##
+#################################
+
+###############
+def kmer_codes(seq, k, canonical=True):
+    """
+    Obtains all k-mers of the sequence provided as 64-bit integers.
+
+    Each base is coded using 2 bits (A:0, C:1, G:2, T:3), so k-mers up to 31 bases are supported.
+    K-mers containing any other character (N, IUPAC) are discarded. If canonical provided, the
+    minimum between the k-mer and its reverse complement is returned.
+
+    :param seq: Nucleotide sequence.
+    :param k: K-mer size (1-31).
+    :param canonical: True/False for returning canonical k-mers.
+
+    :type seq: string or bytes
+    :type k: int
+    :type canonical: bool
+
+    :returns: NumPy uint64 array.
+    """
+    if not 0 < k < 32:
+        raise ValueError("kmer_codes():: k must be between 1 and 31")
+
+    codes = fasta_functions.encode_2bit(seq)
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    ## discard windows containing invalid characters
+    invalid = np.concatenate(([0], np.cumsum(codes == 255)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+
+    codes = codes.astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        forward = (forward << np.uint64(2)) | codes[j:j + n]
+
+    if canonical:
+        reverse = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            reverse |= (np.uint64(3) - codes[j:j + n]) << np.uint64(2 * j)
+        forward = np.minimum(forward, reverse)
+
+    return forward[valid]
+
+###############
+def decode_kmer(value, k):
+    """Returns the nucleotide string for the k-mer code provided."""
+    return "".join("ACGT"[(int(value) >> (2 * (k - 1 - j))) & 3] for j in range(k))
+
+###############
+def merge_counts(kmers, counts):
+    """
+    Merges k-mer count tables given.
+
+    :param kmers: List of NumPy uint64 arrays of k-mers.
+    :param counts: List of NumPy arrays of counts for each k-mer.
+
+    :returns: Tuple of (kmers, counts) with unique sorted k-mers.
+    """
+    kmers = np.concatenate(kmers)
+    counts = np.concatenate(counts)
+    if not len(kmers):
+        return (kmers, counts.astype(np.int64))
+
+    order = np.argsort(kmers, kind='stable')
+    kmers = kmers[order]
+    counts = counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    return (kmers[starts], np.add.reduceat(counts.astype(np.int64), starts))
+
+###############
+def count_kmers_seqs(seqs, k, canonical=True):
+    """
+    Counts k-mers for the list of sequences provided.
+
+    :param seqs: List of nucleotide sequences.
+    :param k: K-mer size (1-31).
+    :param canonical: True/False for counting canonical k-mers.
+
+    :returns: Tuple of (kmers, counts) with unique sorted k-mers.
+    """
+    all_kmers = [kmer_codes(seq, k, canonical) for seq in seqs]
+    if not all_kmers:
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+    kmers, counts = np.unique(np.concatenate(all_kmers), return_counts=True)
+    return (kmers, counts.astype(np.int64))
+
+###############
+def count_kmers(seq_file, k, file_format='fasta', canonical=True, threads=2, chunk_size=5000000, min_count=1):
+    """
+    Counts k-mers for all sequences in a FASTA or FASTQ file.
+
+    Sequences are read in chunks of a given number of bases, each chunk is counted in a pool of
+    processes (see :func:`count_kmers_seqs`) and the partial tables are merged. Sequences longer 
+    than the chunk size (e.g. chromosomes) are split into windows overlapping k-1 bases, so memory 
+    is bounded and a single genome is counted using all processes.
+
+    :param seq_file: Absolute path to sequence file (plain or gzip compressed).
+    :param k: K-mer size (1-31).
+    :param file_format: fasta or fastq.
+    :param canonical: True/False for counting canonical k-mers.
+    :param threads: Number of processes to use.
+    :param chunk_size: Number of bases to include in each chunk.
+    :param min_count: Discard k-mers with lower counts.
+
+    :type seq_file: string
+    :type k: int
+    :type file_format: string
+    :type canonical: bool
+    :type threads: int
+    :type chunk_size: int
+    :type min_count: int
+
+    :returns: Tuple of (kmers, counts) NumPy arrays, sorted by k-mer code.
+    """
+    if file_format == 'fasta':
+        seqs_iter = (seq for header, seq in fasta_functions.fasta_iterator(seq_file))
+    elif file_format == 'fastq':
+        seqs_iter = (bytes(seq) for name, seq, qual in fasta_functions.fastq_iterator(seq_file))
+    else:
+        raise ValueError("count_kmers():: format %s not supported (fasta/fastq)" % file_format)
+
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        pending = []
+        for chunk in _chunk_seqs(seqs_iter, chunk_size, k):
+            pending.append(executor.submit(count_kmers_seqs, chunk, k, canonical))
+
+            ## bound number of chunks in memory
+            if len(pending) >= 2 * threads:
+                chunk_kmers, chunk_counts = pending.pop(0).result()
+                kmers.append(chunk_kmers)
+                counts.append(chunk_counts)
+                if len(kmers) > threads:
+                    merged = merge_counts(kmers, counts)
+                    kmers, counts = [merged[0]], [merged[1]]
+
+        for future in pending:
+            chunk_kmers, chunk_counts = future.result()
+            kmers.append(chunk_kmers)
+            counts.append(chunk_counts)
+
+    kmers, counts = merge_counts(kmers, counts)
+    if min_count > 1:
+        keep = counts >= min_count
+        kmers, counts = kmers[keep], counts[keep]
+
+    return (kmers, counts)
+
+def _chunk_seqs(seqs_iter, chunk_size, k):
+    """
+    Groups sequences into lists containing approximately chunk_size bases.
+    
+    Longer sequences are split into windows of chunk_size k-mer start positions (chunk_size + k - 1 bases), 
+    so each k-mer is counted once.
+    """
+    step = max(chunk_size, 1)
+    chunk = []
+    bases = 0
+    for seq in seqs_iter:
+        if len(seq) > step + k - 1:
+            pieces = (seq[start:start + step + k - 1] for start in range(0, len(seq) - k + 1, step))
+        else:
+            pieces = (seq,)
+        for piece in pieces:
+            chunk.append(piece)
+            bases += len(piece)
+            if bases >= chunk_size:
+                yield chunk
+                chunk = []
+                bases = 0
+    if chunk:
+        yield chunk
+
+###############
+def kmer_table2file(kmers, counts, k, out):
+    """Prints k-mer count table in the output file provided. One k-mer and count per row (tab delimited)."""
+    with open(out, 'w', buffering=1048576) as out_hd:
+        for kmer, count in zip(kmers.tolist(), counts.tolist()):
+            out_hd.write("%s\t%s\n" % (decode_kmer(kmer, k), count))
+
+###############
+def kmer_jaccard(kmers_a, kmers_b):
+    """Returns the Jaccard similarity between two sorted arrays of unique k-mers."""
+    union = len(np.union1d(kmers_a, kmers_b))
+    if not union:
+        return 0.0
+    return len(np.intersect1d(kmers_a, kmers_b, assume_unique=True)) / union
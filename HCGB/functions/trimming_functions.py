@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2020 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Read trimming functions used along ``BacterialTyper`` & ``XICRA`` pipeline.
+
+Trim points are computed for whole batches of reads (see
+:func:`HCGB.functions.fasta_functions.fastq_batch_iterator`) using NumPy
+vectorized operations:
+    - 3' sliding window quality trimming
+
+    - 3' exact match adapter trimming
+
+    - Minimum length filtering
+"""
+## useful imports
+import contextlib
+import numpy as np
+
+from HCGB.functions import fasta_functions
+
+#################################
+###        Trim points         ##
+#################################
+
+###############
+def quality_trim_points(qual, lengths, window=4, threshold=20):
+    """
+    Obtains the 3' trimming position for each read using a sliding window.
+
+    Reads are cut at the start of the first window with a mean quality below the threshold.
+    Reads shorter than the window are not quality trimmed.
+
+    :param qual: 2D array of Phred scores (one read per row).
+    :param lengths: Array of read lengths.
+    :param window: Number of bases to average.
+    :param threshold: Minimum mean quality required.
+
+    :returns: NumPy array of trimming positions (read length if not trimmed).
+    """
+    n_reads, max_len = qual.shape
+    if max_len < window or not n_reads:
+        return lengths.copy()
+
+    cumulative = np.zeros((n_reads, max_len + 1), dtype=np.int64)
+    np.cumsum(qual, axis=1, out=cumulative[:, 1:])
+    window_sum = cumulative[:, window:] - cumulative[:, :-window]
+
+    ## only windows completely within each read
+    starts = np.arange(window_sum.shape[1])
+    low = (window_sum < threshold * window) & (starts <= (lengths - window)[:, None])
+
+    return np.where(low.any(axis=1), low.argmax(axis=1), lengths)
+
+###############
+def adapter_trim_points(seq, lengths, adapter, min_overlap=3):
+    """
+    Obtains the 3' adapter position for each read using exact matches.
+
+    Adapter is searched within the read and as a partial match (adapter prefix) at the end of
+    the read, with at least ``min_overlap`` bases.
+
+    :param seq: 2D array of ASCII codes of the reads (one read per row).
+    :param lengths: Array of read lengths.
+    :param adapter: Adapter sequence.
+    :param min_overlap: Minimum number of adapter bases required at the 3' end.
+
+    :returns: NumPy array of trimming positions (read length if adapter not found).
+    """
+    n_reads, max_len = seq.shape
+    adapter = np.frombuffer(adapter.upper().encode(), dtype=np.uint8)
+    if not n_reads or not len(adapter):
+        return lengths.copy()
+
+    ## uppercase, padded with enough columns to compare the whole adapter
+    padded = np.zeros((n_reads, max_len + len(adapter)), dtype=np.uint8)
+    padded[:, :max_len] = seq & 0xDF
+
+    starts = np.arange(max_len)
+    match = np.ones((n_reads, max_len), dtype=np.bool_)
+    for j, base in enumerate(adapter):
+        ## positions beyond read end are not compared (partial match)
+        match &= (padded[:, j:j + max_len] == base) | ((starts + j) >= lengths[:, None])
+
+    overlap = np.minimum(len(adapter), lengths[:, None] - starts)
+    match &= overlap >= min(min_overlap, len(adapter))
+
+    return np.where(match.any(axis=1), match.argmax(axis=1), lengths)
+
+###############
+def trim_batch(batch, adapter=None, window=4, threshold=20, min_overlap=3):
+    """Returns the trimming position for each read of the batch provided."""
+    ends = batch['lengths']
+    if window and threshold:
+        ends = quality_trim_points(batch['qual'], batch['lengths'], window, threshold)
+    if adapter:
+        ends = np.minimum(ends, adapter_trim_points(batch['seq'], batch['lengths'], adapter, min_overlap))
+    return ends
+
+#################################
+###        Trim files          ##
+#################################
+
+###############
+def trim_fastq(fastq_file, out, adapter=None, window=4, threshold=20, min_length=18, min_overlap=3,
+               fastq_file2=None, out2=None, batch_size=100000, phred_offset=33):
+    """
+    Trims reads of a single or paired-end FASTQ file.
+
+    Reads are processed in batches using :func:`trim_batch`. Pairs are processed in lock-step
+    and both reads are discarded if any of them is shorter than ``min_length`` after trimming.
+    If output file names end with .gz, output is compressed in a background thread.
+
+    :param fastq_file: Absolute path to fastq file (R1 for paired-end; plain or gzip compressed).
+    :param out: Absolute path for the trimmed fastq file.
+    :param adapter: 3' adapter sequence to remove. By default, no adapter trimming.
+    :param window: Number of bases for the quality sliding window. Set to 0 to avoid quality trimming.
+    :param threshold: Minimum mean quality for each window.
+    :param min_length: Minimum length of reads to keep after trimming.
+    :param min_overlap: Minimum number of adapter bases matching at the 3' end.
+    :param fastq_file2: Absolute path to R2 fastq file for paired-end data.
+    :param out2: Absolute path for the trimmed R2 fastq file.
+    :param batch_size: Number of reads to process each time.
+    :param phred_offset: Offset of quality ASCII characters.
+
+    :type fastq_file: string
+    :type out: string
+    :type adapter: string
+    :type window: int
+    :type threshold: int
+    :type min_length: int
+    :type min_overlap: int
+    :type fastq_file2: string
+    :type out2: string
+    :type batch_size: int
+    :type phred_offset: int
+
+    :returns: Dictionary containing number of reads (or pairs) processed and kept.
+    """
+    paired = bool(fastq_file2)
+    if paired and not out2:
+        raise ValueError("trim_fastq():: out2 is required for paired-end data")
+
+    stats = {'reads': 0, 'kept': 0, 'bases': 0, 'bases_kept': 0}
+
+    batches = fasta_functions.fastq_batch_iterator(fastq_file, batch_size, phred_offset)
+    if paired:
+        batches2 = fasta_functions.fastq_batch_iterator(fastq_file2, batch_size, phred_offset)
+
+    ## writers are closed (and flushed) even if any of them fails to open
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(fasta_functions.BlockWriter(out))
+        if paired:
+            writer2 = stack.enter_context(fasta_functions.BlockWriter(out2))
+
+        for batch in batches:
+            ends = trim_batch(batch, adapter, window, threshold, min_overlap)
+            keep = ends >= min_length
+
+            if paired:
+                batch2 = next(batches2, None)
+                if batch2 is None or len(batch2['names']) != len(batch['names']):
+                    raise ValueError("trim_fastq():: different number of reads in %s and %s" % (fastq_file, fastq_file2))
+                ends2 = trim_batch(batch2, adapter, window, threshold, min_overlap)
+                keep &= ends2 >= min_length
+                writer2.write(fasta_functions.fastq_batch2bytes(batch2, ends2, keep, phred_offset))
+
+            writer.write(fasta_functions.fastq_batch2bytes(batch, ends, keep, phred_offset))
+
+            stats['reads'] += len(keep)
+            stats['kept'] += int(keep.sum())
+            stats['bases'] += int(batch['lengths'].sum())
+            stats['bases_kept'] += int(ends[keep].sum())
+
+        if paired and next(batches2, None) is not None:
+            raise ValueError("trim_fastq():: different number of reads in %s and %s" % (fastq_file, fastq_file2))
+
+    return (stats)
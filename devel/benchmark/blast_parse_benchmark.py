@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2020 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Throughput benchmark for blast_functions.parse.
+
+Compares the current implementation (single tokenisation and filters on raw
+fields) with the previous one (groupby keys and Hsp built for every line).
+Both the previous parse and Hsp are frozen here, so later changes of Hsp are measured.
+
+Usage: python devel/benchmark/blast_parse_benchmark.py [--lines 1000000] [--evalue 1e-5]
+"""
+import time
+import random
+import argparse
+import tempfile
+from itertools import groupby
+
+from HCGB.functions import blast_functions
+
+############################################################
+class HspLegacy:
+    """Previous implementation of blast_functions.Hsp (14 fields), kept for comparison."""
+
+    def __init__(self,entry):
+        bt_fields = entry.split('\t')
+        self.qid = bt_fields[0]
+        self.sid = bt_fields[1]
+        self.pident = float(bt_fields[2])
+        self.length = int(bt_fields[3])
+        self.mismatch = int(bt_fields[4])
+        self.gaps = int(bt_fields[5])
+        self.qstart = int(bt_fields[6])
+        self.qend = int(bt_fields[7])
+        self.sstart = int(bt_fields[8])
+        self.send = int(bt_fields[9])
+        self.evalue = float(bt_fields[10])
+        self.bitscore = float(bt_fields[11])
+        self.qlen = float(bt_fields[12])
+        self.slen = float(bt_fields[13])
+
+############################################################
+def parse_legacy(handle, eval_thresh=10, aln_thresh=0, length_thresh=0):
+    """Previous implementation of blast_functions.parse, kept for comparison."""
+    for qid, blasts in groupby(handle, lambda l: l.split()[0]):
+        hits = []
+        for sid, hsps in groupby(blasts, lambda l: l.split()[1]):
+            hsps_temp = []
+            for line in hsps:
+                hsp = HspLegacy(line)
+                if (hsp.qid == hsp.sid):
+                    continue
+                aln = (int(hsp.length)/int(hsp.qlen))*100
+                if aln >= aln_thresh and hsp.evalue <= eval_thresh and hsp.qlen > length_thresh:
+                    hsps_temp.append(hsp)
+            if hsps_temp: hits.append(hsps_temp)
+        yield blast_functions.BlastRecord(qid=qid, hits=hits)
+
+############################################################
+def create_blast_file(file_name, lines, seed=100):
+    """Creates a synthetic BLAST tabular file (-outfmt '6 std qlen slen')."""
+    rng = random.Random(seed)
+    with open(file_name, 'w') as out_hd:
+        count = 0
+        query = 0
+        while count < lines:
+            query += 1
+            for hit in range(rng.randint(1, 50)):
+                qlen = rng.randint(100, 2000)
+                length = rng.randint(20, qlen)
+                out_hd.write("q%s\ts%s\t%.2f\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%.1e\t%.1f\t%s\t%s\n" % (
+                    query, rng.randint(1, 100000), rng.uniform(60, 100), length, rng.randint(0, 50), 
+                    rng.randint(0, 10), 1, length, 1, length, 10 ** -rng.uniform(0, 100), 
+                    rng.uniform(20, 1000), qlen, rng.randint(100, 5000)))
+                count += 1
+
+############################################################
+def time_parse(function, file_name, **kwargs):
+    """Returns time spent and number of HSPs retrieved by the parse function provided."""
+    start = time.time()
+    hsps = 0
+    with open(file_name) as handle:
+        for record in function(handle, **kwargs):
+            hsps += sum(len(hit) for hit in record.hits)
+    return time.time() - start, hsps
+
+############################################################
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark blast_functions.parse')
+    parser.add_argument('--lines', type=int, default=1000000, help='Number of lines to generate')
+    parser.add_argument('--evalue', type=float, default=1e-5, help='E-value threshold')
+    parser.add_argument('--aln', type=float, default=50, help='Alignment threshold (%%)')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.tsv') as tmp:
+        create_blast_file(tmp.name, args.lines)
+        options = {'eval_thresh': args.evalue, 'aln_thresh': args.aln}
+
+        for name, function in (('legacy', parse_legacy), ('current', blast_functions.parse)):
+            spent, hsps = time_parse(function, tmp.name, **options)
+            print("%-8s %8.2f s  %10.0f lines/s  %s HSPs retrieved" % (name, spent, args.lines / spent, hsps))
+
+############################################################
+if __name__== "__main__":
+    main()